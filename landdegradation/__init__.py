@@ -1,5 +1,28 @@
 __version__ = '0.54'
 
+import importlib
+
+# Submodules are imported on first attribute access (for example
+# landdegradation.productivity) using a module __getattr__ (PEP 562, Python
+# 3.7+). Importing the package imports none of them, and stats can be used
+# without Earth Engine. The indicator modules and util import ee when they
+# are loaded, but no module needs an initialized ee session to be imported.
+_SUBMODULES = ('carbon', 'climate_quality', 'download', 'esai',
+               'forest_change', 'forest_fire', 'land_cover', 'ldn',
+               'management_quality', 'materialize', 'metrics', 'preproc',
+               'productivity', 'raster', 'soc', 'soil_quality', 'stats',
+               'urban_area', 'util', 'vegetation_quality', 'zonal')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_SUBMODULES))
+
 
 class LandDegradationError(Exception):
     """Base class for exceptions in this module."""
@@ -8,10 +8,81 @@ from landdegradation.util import TEImage
 from landdegradation.schemas.schemas import BandInfo
 
 
+# IPCC root to shoot ratios, by climate (1: tropical moist, 2: tropical dry, 
+# 3: temperate) and forest type (1: broadleaf, 2: conifer, 3: mixed, 4: 
+# savanna), for low, mid and high biomass classes. Tropical moist forests 
+# have two biomass classes (below 125 Mg/ha and from 125 Mg/ha), temperate 
+# forests three (up to 75 (50 for conifers), up to 150, and above 150 Mg/ha). 
+# Mixed temperate forests use the mean of the broadleaf and conifer ratios. 
+# Savannas use the same ratio regardless of climate. Forest type 0 (pixels
+# outside the ESA forest classes) uses the tropical ratios, which do not
+# depend on forest type, and has no ratio in temperate climates.
+RS_RATIO_IPCC = {1: {0: [0.42, 0.24], 1: [0.42, 0.24], 2: [0.42, 0.24], 3: [0.42, 0.24]},
+                 2: {0: [0.27], 1: [0.27], 2: [0.27], 3: [0.27]},
+                 3: {1: [0.43, 0.26, 0.24],
+                     2: [0.46, 0.32, 0.23],
+                     3: [(0.46 + 0.43) / 2, (0.32 + 0.26) / 2, (0.23 + 0.24) / 2]}}
+RS_RATIO_SAVANNA = 2.8
+
+# tileScale used when the emissions table is evaluated interactively, to
+# reduce the memory used per tile
+STATS_TILE_SCALE = 4
+
+
+def _rs_ratio_lookup():
+    "Codes (climate * 100 + forest type * 10 + biomass class) and ratios"
+    codes = []
+    ratios = []
+    for climate in [0, 1, 2, 3]:
+        for f_type in [0, 1, 2, 3, 4]:
+            for biomass_class in [0, 1, 2]:
+                if f_type == 4:
+                    ratio = RS_RATIO_SAVANNA
+                elif climate in RS_RATIO_IPCC and f_type in RS_RATIO_IPCC[climate]:
+                    classes = RS_RATIO_IPCC[climate][f_type]
+                    ratio = classes[min(biomass_class, len(classes) - 1)]
+                else:
+                    continue
+                codes.append(climate * 100 + f_type * 10 + biomass_class)
+                ratios.append(ratio)
+    return codes, ratios
+
+
+def _emissions_table(tbcarbon, fc_str, lossyear, geometry, year_start,
+                     year_end, scale):
+    """
+    Carbon lost (t C) and emissions (t CO2e) per year of forest loss.
+
+    Uses a single pixel area weighted sum grouped by loss year, evaluated
+    interactively with bestEffort (so large AOIs are reduced at a coarser
+    scale). Raises ee.EEException if the evaluation fails.
+    """
+    lost = fc_str.And(lossyear.gt(year_start - 2000)).And(lossyear.lte(year_end - 2000))
+    # t C/ha * ha per pixel
+    carbon_lost = tbcarbon.multiply(ee.Image.pixelArea().divide(1e4)).updateMask(lost)
+    groups = carbon_lost.addBands(lossyear) \
+        .reduceRegion(reducer=ee.Reducer.sum().group(groupField=1, groupName='lossyear'),
+                      geometry=geometry, scale=scale, maxPixels=1e13,
+                      bestEffort=True, tileScale=STATS_TILE_SCALE)
+    table = dict((str(year), {'carbon': 0, 'co2e': 0})
+                 for year in range(year_start + 1, year_end + 1))
+    for group in groups.getInfo()['groups']:
+        # One ton of carbon equals 44/12 = 11/3 = 3.67 tons of carbon dioxide
+        table[str(2000 + int(group['lossyear']))] = {'carbon': group['sum'],
+                                                     'co2e': group['sum'] * 44 / 12}
+    return table
+
+
 def tc(geometry, fc_threshold, year_start, year_end, method, biomass_data, EXECUTION_ID, 
-       logger):
+       logger, emissions=False):
     """
     Calculate total carbon (in belowground and aboveground biomass).
+
+    If emissions is True, the carbon lost (t C) and emissions (t CO2e) for 
+    each year of forest loss are also computed, and returned in the metadata
+    of the total carbon band under 'emissions'. If they can not be
+    evaluated (for example by timing out on a large AOI) the failure is
+    logged and the table left out.
     """
     logger.debug("Entering tc function.")
     # geom = ee.Geometry.Polygon(geometry)
@@ -24,7 +95,12 @@ def tc(geometry, fc_threshold, year_start, year_end, method, biomass_data, EXECU
 
     # Aboveground Live Woody Biomass per Hectare (Mg/Ha)
     if biomass_data == 'woodshole':
-        agb = ee.ImageCollection("users/geflanddegradation/toolbox_datasets/forest_agb_30m_gfw").mosaic().unmask(0)
+        # Only mosaic the tiles that overlap the AOI
+        agb = ee.ImageCollection("users/geflanddegradation/toolbox_datasets/forest_agb_30m_gfw") \
+            .filterBounds(geometry) \
+            .mosaic() \
+            .unmask(0) \
+            .clip(geometry)
     elif biomass_data == 'geocarbon':
         agb = ee.Image("users/geflanddegradation/toolbox_datasets/forest_agb_1km_geocarbon").clip(geometry)
     else:
@@ -36,11 +112,13 @@ def tc(geometry, fc_threshold, year_start, year_end, method, biomass_data, EXECU
     water = ee.Image("JRC/GSW1_0/GlobalSurfaceWater").select("occurrence").clip(geometry)
     water = water.reproject(crs=hansen.projection())
 
-    # reclass to 1.broadleaf, 2.conifer, 3.mixed, 4.savanna
+    # reclass to 1.broadleaf, 2.conifer, 3.mixed, 4.savanna, and 0 outside
+    # the forest classes (so that tropical pixels still get a ratio)
     f_type = ee.Image("users/geflanddegradation/toolbox_datasets/esa_forest_expanded_2015") \
         .clip(geometry) \
         .remap([50,60,61,62,70,71,72,80,81,82,90,100,110],
-               [ 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 3,  3,  3])
+               [ 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 3,  3,  3]) \
+        .unmask(0)
     f_type = f_type.reproject(crs=hansen.projection())
 
     # IPCC climate zones reclassified as from http://eusoils.jrc.ec.europa.eu/projects/RenewableEnergy/
@@ -56,33 +134,16 @@ def tc(geometry, fc_threshold, year_start, year_end, method, biomass_data, EXECU
 
     # Root to shoot ratio methods
     if method == 'ipcc':
-        rs_ratio = (ee.Image(-32768)
-            # low biomass wet tropical forest
-            .where(climate.eq(1).And(agb.lte(125)), 0.42)
-            # high biomass wet tropical forest
-            .where(climate.eq(1).And(agb.gte(125)), 0.24)
-            # dry tropical forest
-            .where(climate.eq(2), 0.27)
-            # low biomass temperate conifer forest
-            .where(climate.eq(3).And(f_type.eq(2).And(agb.lte(50))), 0.46)
-            # mid biomass temperate conifer forest
-            .where(climate.eq(3).And(f_type.eq(2).And(agb.gte(50)).And(agb.lte(150))), 0.32)
-            # high biomass temperate conifer forest
-            .where(climate.eq(3).And(f_type.eq(2).And(agb.lte(150))), 0.23)
-            # low biomass temperate broadleaf forest
-            .where(climate.eq(3).And(f_type.eq(1).And(agb.lte(75))), 0.43)
-            # low biomass temperate broadleaf forest
-            .where(climate.eq(3).And(f_type.eq(1).And(agb.gte(75)).And(agb.lte(150))), 0.26)
-            # low biomass temperate broadleaf forest
-            .where(climate.eq(3).And(f_type.eq(1).And(agb.lte(150))), 0.24)
-            # low biomass temperate mixed forest
-            .where(climate.eq(3).And(f_type.eq(1).And(agb.lte(75))), (0.46+0.43)/2)
-            # low biomass temperate mixed forest
-            .where(climate.eq(3).And(f_type.eq(1).And(agb.gte(75)).And(agb.lte(150))), (0.32+0.26)/2)
-            # low biomass temperate mixed forest
-            .where(climate.eq(3).And(f_type.eq(1).And(agb.lte(150))), (0.23+0.24)/2)
-            # savanas regardless of climate
-            .where(f_type.eq(4), 2.8))
+        # Biomass class: 0 low, 1 mid, 2 high. Thresholds (Mg/ha) depend on 
+        # the climate and forest type (see RS_RATIO_IPCC).
+        low_threshold = f_type.remap([1, 2, 3], [75, 50, 75], 75)
+        biomass_class = agb.gt(low_threshold).add(agb.gt(150)) \
+            .where(climate.eq(1), agb.gte(125))
+        # Look up the ratio from a packed (climate, forest type, biomass 
+        # class) code in a single remap
+        rs_code = climate.multiply(100).add(f_type.multiply(10)).add(biomass_class)
+        codes, ratios = _rs_ratio_lookup()
+        rs_ratio = rs_code.remap(codes, ratios, -32768)
         bgb = agb.multiply(rs_ratio)
     elif (method == 'mokany'):
         # calculate average above and below ground biomass
@@ -121,6 +182,21 @@ def tc(geometry, fc_threshold, year_start, year_end, method, biomass_data, EXECU
         .addBands((tbcarbon.multiply(10)).multiply(fc_str)).unmask(-32768)
     output = output.reproject(crs=hansen.projection())
 
+    tc_metadata = {'year_start': year_start,
+                   'year_end': year_end,
+                   'method': method,
+                   'threshold': fc_threshold}
+    if emissions:
+        logger.debug("Computing emissions table.")
+        try:
+            tc_metadata['emissions'] = _emissions_table(tbcarbon, fc_str,
+                                                        hansen.select('lossyear').unmask(0),
+                                                        geometry, year_start, year_end,
+                                                        hansen.projection().nominalScale())
+            tc_metadata['emissions_units'] = {'carbon': 't C', 'co2e': 't CO2e'}
+        except ee.EEException as e:
+            logger.debug("Failed to compute emissions table: {}".format(e))
+
     logger.debug("Setting up output.")
     out = TEImage(output.int16().clip(geometry),
                   [BandInfo("Forest loss", add_to_map=True, metadata={'year_start': year_start,
@@ -129,8 +205,5 @@ def tc(geometry, fc_threshold, year_start, year_end, method, biomass_data, EXECU
                                                                       'ramp_max': year_end - 2000,
                                                                       'threshold': fc_threshold}),
                    BandInfo("Root/shoot ratio", add_to_map=False, metadata={'method': method}),
-                   BandInfo("Total carbon", add_to_map=True, metadata={'year_start': year_start,
-                                                                       'year_end': year_end,
-                                                                       'method': method,
-                                                                       'threshold': fc_threshold})])
+                   BandInfo("Total carbon", add_to_map=True, metadata=tc_metadata)])
     return out
@@ -5,17 +5,17 @@ from __future__ import print_function
 import ee
 
 from landdegradation import stats, GEEIOError
-from landdegradation.util import TEImage
+from landdegradation.util import TEImage, plan_storage, to_grid, GRID_NATIVE
 from landdegradation.schemas.schemas import BandInfo
 
-def climate_quality(year, geometry, EXECUTION_ID,logger):
+def climate_quality_index(year, geometry):
     """
     ===========================================================================================
                  CLIMATE QUALITY INDEX (CQI)
     ===========================================================================================
-
+    Calculate the (unclassified) climate quality index, at the TerraClimate
+    resolution.
     """
-    logger.debug("Entering climate quality function.")
 
     terra_climate = ee.ImageCollection("IDAHO_EPSCOR/TERRACLIMATE") \
                 .filter(ee.Filter.date('{}-01-01'.format(year), '{}-12-31'.format(year))) \
@@ -61,17 +61,34 @@ def climate_quality(year, geometry, EXECUTION_ID,logger):
         'aridity_index':aridityIndex,
         })
 
-    cqi_class = cqi \
+    return cqi
+
+
+def climate_quality_classes(cqi):
+    """Classify the climate quality index into 3 classes."""
+    return cqi \
         .where(cqi.lt(1.15), 1) \
         .where(cqi.gte(1.15).And(cqi.lte(1.81)), 2) \
         .where(cqi.gt(1.81), 3) \
         .rename('Climate Quality Reclass')
 
-    srtm_proj = ee.Image("USGS/SRTMGL1_003").projection()
 
-    # resample parent material to srtm projection
-    cqi_class = cqi_class.reproject(crs=srtm_proj)
+def climate_quality(year, geometry, EXECUTION_ID,logger, grid=GRID_NATIVE):
+    """Calculate the climate quality index (CQI), classified into 3 classes.
+
+    grid is the output grid policy (see util.select_grid). The default keeps
+    the index on the TerraClimate grid. Use a scale of 30 for the SRTM 30 m
+    grid used previously.
+    """
+    logger.debug("Entering climate quality function.")
+    cqi_class = climate_quality_classes(climate_quality_index(year, geometry))
+
+    terra_climate_proj = ee.Image(ee.ImageCollection("IDAHO_EPSCOR/TERRACLIMATE").first()).select('pr').projection()
+
+    # resample to the output grid, if needed
+    cqi_class = to_grid(cqi_class, [terra_climate_proj], grid)
     
     return TEImage(cqi_class.clip(geometry),
-        [BandInfo("Climate Quality Index (year)", add_to_map=True, metadata={'year':year})]
+        [BandInfo("Climate Quality Index (year)", add_to_map=True, metadata={'year':year})],
+        storage=[plan_storage(1, 3, categorical=True)]
     )
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ee
+
+from landdegradation.util import TEImage, plan_storage
+from landdegradation.land_cover import load_lc
+from landdegradation.soil_quality import soil_quality_index, soil_quality_classes
+from landdegradation.climate_quality import climate_quality_index, \
+    climate_quality_classes
+from landdegradation.vegetation_quality import vegetation_quality_index, \
+    vegetation_quality_classes
+from landdegradation.management_quality import management_quality_index, \
+    management_quality_classes
+from landdegradation.schemas.schemas import BandInfo
+
+
+def esai_classes(esai):
+    """Classify the ESAI into non-affected (1), potential (2), fragile (3)
+    and critical (4) environmentally sensitive areas."""
+    return esai \
+        .where(esai.lt(1.17), 1) \
+        .where(esai.gte(1.17).And(esai.lt(1.225)), 2) \
+        .where(esai.gte(1.225).And(esai.lt(1.375)), 3) \
+        .where(esai.gte(1.375), 4)
+
+
+def esai(year, depth, texture_matrix, ndvi_start, ndvi_end, drought_matrix,
+         fire_matrix, erosion_matrix, lu_matrix, geometry, EXECUTION_ID,
+         logger, proj=None):
+    """
+    ===========================================================================================
+                 ENVIRONMENTALLY SENSITIVE AREA INDEX (ESAI)
+    ===========================================================================================
+    Calculate the soil, climate, vegetation and management quality indices
+    and the composite ESAI in a single graph:
+
+    ESAI = (SQI * CQI * VQI * MQI)^1/4
+
+    All four indices are computed on one common grid (proj, defaulting to the
+    ESA CCI land cover grid that the vegetation and management indices are
+    defined on), with the land cover stack loaded once and shared. The
+    output has one band for the ESAI, one for the ESAI classes, and one for
+    the classes of each of the quality indices.
+    """
+    logger.debug("Entering esai function.")
+
+    lc = load_lc(geometry)
+    if proj is None:
+        proj = lc.projection()
+
+    sqi = soil_quality_index(depth, texture_matrix, geometry, logger, proj=proj)
+    cqi = climate_quality_index(year, geometry).reproject(crs=proj)
+    vqi = vegetation_quality_index(year, ndvi_start, ndvi_end, drought_matrix,
+                                   fire_matrix, erosion_matrix, geometry, lc=lc)
+    mqi = management_quality_index(year, lu_matrix, geometry, logger, lc=lc)
+
+    esai_img = ee.Image().expression('(sqi * cqi * vqi * mqi) ** (1/4)', {
+        'sqi': sqi,
+        'cqi': cqi,
+        'vqi': vqi,
+        'mqi': mqi
+        }).reproject(crs=proj)
+
+    logger.debug("Setting up output.")
+    output = esai_img \
+        .addBands(esai_classes(esai_img)) \
+        .addBands(soil_quality_classes(sqi)) \
+        .addBands(climate_quality_classes(cqi)) \
+        .addBands(vegetation_quality_classes(vqi)) \
+        .addBands(management_quality_classes(mqi)) \
+        .float()
+
+    return TEImage(output.clip(geometry),
+        [BandInfo("Environmentally Sensitive Area Index", metadata={'year': year}),
+         BandInfo("Environmentally Sensitive Area Index (classes)", add_to_map=True, metadata={'year': year}),
+         BandInfo("Soil Quality Index (cm deep)", metadata={'depth': depth}),
+         BandInfo("Climate Quality Index (year)", metadata={'year': year}),
+         BandInfo("Vegetation Quality Index", metadata={'year': year}),
+         BandInfo("Management Quality Index", metadata={'year': year})],
+        storage=[plan_storage(1, 2, precision=0.001),
+                 plan_storage(1, 4, categorical=True)] +
+                [plan_storage(1, 3, categorical=True)] * 4)
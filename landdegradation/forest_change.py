@@ -5,11 +5,17 @@ from __future__ import print_function
 import ee
 
 from landdegradation import stats, GEEIOError
-from landdegradation.util import TEImage
+from landdegradation.util import TEImage, LazyImage, plan_storage
 from landdegradation.schemas.schemas import BandInfo
 
-# This dataset is updated yearly, so we get the latest version.
-gfc2019 = ee.Image("UMD/hansen/global_forest_change_2019_v1_7")
+# This dataset is updated yearly, so we get the latest version. The image is
+# only created when first used, so that importing this module does not need
+# an initialized Earth Engine session.
+gfc2019 = LazyImage("UMD/hansen/global_forest_change_2019_v1_7")
+
+# tileScale used when the loss areas are evaluated interactively, to reduce
+# the memory used per tile
+STATS_TILE_SCALE = 4
 
 """
 Calulate forest loss year for a given period over a given region
@@ -29,7 +35,8 @@ def forest_loss_year( year, geojson,EXECUTION_ID, logger):
     lossAreaImage = lossImageAOI.multiply(ee.Image.pixelArea())
 
     return TEImage(lossAreaImage.updateMask(lossAreaImage), 
-                    [BandInfo("Forest Loss in {0}".format(year), add_to_map=True, metadata={year:year})])
+                    [BandInfo("Forest Loss in {0}".format(year), add_to_map=True, metadata={year:year})],
+                    storage=[plan_storage(0, 65534)])
 
 
 """
@@ -47,7 +54,8 @@ def forest_loss(geojson, EXECUTION_ID, logger):
     lossAreaImage = lossImageAOI.multiply(ee.Image.pixelArea())
 
     return TEImage(lossAreaImage.updateMask(lossAreaImage), 
-                    [BandInfo("Forest Loss", add_to_map=True, metadata={})])
+                    [BandInfo("Forest Loss", add_to_map=True, metadata={})],
+                    storage=[plan_storage(0, 65534)])
 
 """
 Calulate forest gain over a given region
@@ -63,7 +71,8 @@ def forest_gain(geojson,EXECUTION_ID, logger):
     gainAreaImage = gainImageAOI.multiply(ee.Image.pixelArea())
 
     return TEImage(gainAreaImage.updateMask(gainAreaImage), 
-                    [BandInfo("Forest Gain", add_to_map=True, metadata={})])
+                    [BandInfo("Forest Gain", add_to_map=True, metadata={})],
+                    storage=[plan_storage(0, 65534)])
 
 """
 Calulate forest cover for a given period over a given region
@@ -79,5 +88,101 @@ def forest_cover(year_start, year_end, ndvi_gee_dataset, geojson,EXECUTION_ID, l
     treeCoverAreaImage = treeCoverAOI.multiply(ee.Image.pixelArea())
 
     return TEImage(treeCoverAreaImage.updateMask(treeCoverAreaImage), 
-                    [BandInfo("Tree Cover", add_to_map=True, metadata={})])
+                    [BandInfo("Tree Cover", add_to_map=True, metadata={})],
+                    storage=[plan_storage(0, 655340, precision=10)])
+
+
+def _loss_years(year_start, year_end, poly):
+    """Loss year (years since 2000) over poly, masked outside the period
+
+    Loss years start in 2001, as a lossyear of 0 means no loss, so the
+    period is clamped to start no earlier than 2001.
+    """
+    lossyear = gfc2019.select(['lossyear']).clip(poly)
+    return lossyear.updateMask(lossyear.gte(max(year_start - 2000, 1)).And(lossyear.lte(year_end - 2000)))
+
+
+def _loss_areas(poly, lossyear, **kwargs):
+    """Area lost per year (in sq m) as an unevaluated ee.Dictionary
+
+    kwargs are passed to reduceRegion (for example bestEffort or tileScale).
+    """
+    # area lost per year in a single grouped reduction
+    return ee.Image.pixelArea().addBands(lossyear) \
+        .reduceRegion(reducer=ee.Reducer.sum().group(groupField=1, groupName='lossyear'),
+                      geometry=poly, scale=gfc2019.projection().nominalScale(),
+                      maxPixels=1e13, **kwargs)
+
+
+def forest_loss_table(year_start, year_end, geojson):
+    """
+    Area lost per year as an ee.FeatureCollection, for export with the raster.
+
+    The collection has one feature, without geometry, per year with loss,
+    with the loss year and the area lost (in sq m). Nothing is evaluated, so
+    it can be exported with ee.batch.Export.table for AOIs of any size.
+    """
+    poly = ee.Geometry(geojson, opt_geodesic=False)
+    groups = ee.List(_loss_areas(poly, _loss_years(year_start, year_end, poly)).get('groups'))
+    return ee.FeatureCollection(groups.map(
+        lambda group: ee.Feature(None, {'year': ee.Number(ee.Dictionary(group).get('lossyear')).add(2000),
+                                        'area': ee.Dictionary(group).get('sum')})))
+
+
+"""
+Calculate forest loss for each year of a period over a given region,
+optionally with a table of the area lost per year
+"""
+def forest_loss_series(year_start, year_end, geojson, EXECUTION_ID, logger,
+                       single_band=False, area_table=False):
+    """
+    If area_table is True the area lost per year (in sq m) is evaluated
+    interactively (with bestEffort, so large AOIs are reduced at a coarser
+    scale) and returned in the metadata of the first band, under
+    'area_lost'. If the evaluation fails (for example by timing out) it is
+    left out. For large AOIs export forest_loss_table instead.
+
+    As GFC loss years start in 2001, a year_start before 2001 is treated as
+    2001.
+    """
+    logger.debug("Entering Forest Loss Series function.")
+
+    year_start = max(year_start, 2001)
+    if year_end < year_start:
+        raise GEEIOError("Forest loss period must end in or after {}".format(year_start))
+
+    # Make sure the bounding box of the poly is used, and not the geodesic 
+    # version, for the clipping
+    poly = ee.Geometry(geojson, opt_geodesic=False)
 
+    lossyear = _loss_years(year_start, year_end, poly)
+
+    metadata = {'year_start': year_start, 'year_end': year_end}
+    if area_table:
+        try:
+            areas = _loss_areas(poly, lossyear, bestEffort=True,
+                                tileScale=STATS_TILE_SCALE).getInfo()
+            table = dict((str(year), 0) for year in range(year_start, year_end + 1))
+            for group in areas['groups']:
+                table[str(2000 + int(group['lossyear']))] = group['sum']
+            metadata['area_lost'] = table
+            metadata['area_units'] = 'sq m'
+        except ee.EEException as e:
+            logger.debug("Failed to compute forest loss areas: {}".format(e))
+
+    if single_band:
+        return TEImage(lossyear.add(2000),
+                       [BandInfo("Forest Loss Year", add_to_map=True, metadata=metadata)],
+                       storage=[plan_storage(2000, 2100, categorical=True)])
+
+    pixel_area = ee.Image.pixelArea()
+    bands = []
+    band_info = []
+    for year in range(year_start, year_end + 1):
+        bands.append(pixel_area.updateMask(lossyear.eq(year - 2000)))
+        band_info.append(BandInfo("Forest Loss in {0}".format(year),
+                                  add_to_map=(year == year_end),
+                                  metadata={'year': year}))
+    band_info[0].metadata = dict(band_info[0].metadata, **metadata)
+    return TEImage(ee.Image.cat(bands), band_info,
+                   storage=[plan_storage(0, 65534)] * len(bands))
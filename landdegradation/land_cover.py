@@ -5,11 +5,27 @@ from __future__ import print_function
 import ee
 
 from landdegradation.util import TEImage
+from landdegradation.materialize import materialized
 from landdegradation.schemas.schemas import BandInfo
 
 
+def load_lc(area=None):
+    """
+    Load the ESA CCI annual land cover stack, with nodata masked.
+
+    If area is given the stack is clipped to it. The result can be shared
+    between indicators that use land cover for the same AOI.
+    """
+    lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018")
+    if area is not None:
+        lc = lc.clip(area)
+    lc = lc.where(lc.eq(9999), -32768)
+    lc = lc.updateMask(lc.neq(-32768))
+    return lc
+
+
 def land_cover(geometry, year_baseline, year_target, trans_matrix,
-               remap_matrix, EXECUTION_ID, logger):
+               remap_matrix, EXECUTION_ID, logger, lc=None):
     """
     Calculate land cover indicator.
     """
@@ -18,14 +34,20 @@ def land_cover(geometry, year_baseline, year_target, trans_matrix,
     # Location
     area = ee.FeatureCollection(geom)
     ## land cover
-    lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018").clip(area)
-    lc = lc.where(lc.eq(9999), -32768)
-    lc = lc.updateMask(lc.neq(-32768))
+    if lc is None:
+        lc = load_lc(area)
 
     # Remap LC according to input matrix
-    lc_remapped = lc.select('y{}'.format(year_baseline)).remap(remap_matrix[0], remap_matrix[1])
-    for year in range(year_baseline + 1, year_target + 1):
-        lc_remapped = lc_remapped.addBands(lc.select('y{}'.format(year)).remap(remap_matrix[0], remap_matrix[1]))
+    def remap_lc():
+        lc_remapped = lc.select('y{}'.format(year_baseline)).remap(remap_matrix[0], remap_matrix[1])
+        for year in range(year_baseline + 1, year_target + 1):
+            lc_remapped = lc_remapped.addBands(lc.select('y{}'.format(year)).remap(remap_matrix[0], remap_matrix[1]))
+        return lc_remapped
+    lc_remapped = materialized('lc_7class',
+                               {'year_baseline': year_baseline,
+                                'year_target': year_target,
+                                'remap_matrix': remap_matrix},
+                               remap_lc, geometry, lc.projection(), logger)
 
     ## target land cover map reclassified to IPCC 6 classes
     lc_bl = lc_remapped.select(0)
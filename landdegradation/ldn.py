@@ -0,0 +1,181 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ee
+
+from landdegradation import GEEIOError
+from landdegradation.productivity import load_ndvi, productivity_trajectory, \
+    productivity_performance, productivity_state
+from landdegradation.land_cover import load_lc, land_cover
+from landdegradation.soc import soc
+from landdegradation.util import TEImage, plan_storage
+from landdegradation.schemas.schemas import BandInfo
+
+
+def ldn_sub_indicators(geometry, geojson, ndvi_gee_dataset, trajectory=None,
+                       performance=None, state=None, lc=None, soc_params=None,
+                       EXECUTION_ID=None, logger=None):
+    """
+    Calculate the SDG 15.3.1 sub-indicators for one AOI as a single image.
+
+    The NDVI and ESA CCI land cover stacks are loaded, clipped and masked once
+    and shared by every sub-indicator. The outputs are merged into one TEImage
+    (with the band info of each sub-indicator concatenated in order) so that
+    they can be exported with a single task.
+
+    Each of trajectory, performance, state, lc and soc_params is a dictionary
+    of the parameters specific to that sub-indicator (the same keyword
+    arguments taken by the matching function, minus the AOI, datasets,
+    EXECUTION_ID and logger), or None to skip it. For example:
+
+        trajectory={'year_start': 2001, 'year_end': 2015,
+                    'method': 'ndvi_trend', 'climate_gee_dataset': None}
+        performance={'year_start': 2001, 'year_end': 2015}
+        state={'year_bl_start': 2001, 'year_bl_end': 2012,
+               'year_tg_start': 2013, 'year_tg_end': 2015}
+        lc={'year_baseline': 2001, 'year_target': 2015,
+            'trans_matrix': [...], 'remap_matrix': [...]}
+        soc_params={'year_start': 2001, 'year_end': 2015, 'fl': 'per pixel',
+                    'remap_matrix': [...], 'dl_annual_lc': False}
+    """
+    logger.debug("Entering ldn_sub_indicators function.")
+    if not any([trajectory, performance, state, lc, soc_params]):
+        raise GEEIOError("Must specify at least one sub-indicator")
+
+    geom = ee.Geometry.Polygon(geometry)
+    area = ee.FeatureCollection(geom)
+
+    # Shared inputs
+    if trajectory or performance or state:
+        ndvi_1yr = load_ndvi(ndvi_gee_dataset, area)
+    if performance or lc or soc_params:
+        lc_stack = load_lc(area)
+
+    outputs = []
+    if trajectory:
+        outputs.append(productivity_trajectory(geometry,
+                                               ndvi_gee_dataset=ndvi_gee_dataset,
+                                               logger=logger, ndvi_1yr=ndvi_1yr,
+                                               **trajectory))
+    if performance:
+        outputs.append(productivity_performance(geometry,
+                                                ndvi_gee_dataset=ndvi_gee_dataset,
+                                                geojson=geojson,
+                                                EXECUTION_ID=EXECUTION_ID,
+                                                logger=logger, ndvi_1yr=ndvi_1yr,
+                                                lc=lc_stack, **performance))
+    if state:
+        outputs.append(productivity_state(geometry,
+                                          ndvi_gee_dataset=ndvi_gee_dataset,
+                                          EXECUTION_ID=EXECUTION_ID,
+                                          logger=logger, ndvi_1yr=ndvi_1yr,
+                                          **state))
+    if lc:
+        outputs.append(land_cover(geometry, EXECUTION_ID=EXECUTION_ID,
+                                  logger=logger, lc=lc_stack, **lc))
+    if soc_params:
+        outputs.append(soc(geometry, EXECUTION_ID=EXECUTION_ID, logger=logger,
+                           lc=lc_stack, **soc_params))
+
+    logger.debug("Merging sub-indicator outputs.")
+    out = outputs[0]
+    for other in outputs[1:]:
+        out.merge(other)
+
+    return out
+
+
+def _select_band(te_image, name):
+    "Return the first band of a TEImage with the given band info name"
+    for i, bi in enumerate(te_image.band_info):
+        if bi.name == name:
+            return te_image.image.select(i)
+    raise GEEIOError('Band "{}" not found in sub-indicator image'.format(name))
+
+
+def sdg_15_3_1(sub_indicators, geometry, scale, EXECUTION_ID, logger,
+               soc_threshold=10, area_summary=False):
+    """
+    Calculate the SDG 15.3.1 indicator from the sub-indicator image.
+
+    sub_indicators is the TEImage returned by ldn_sub_indicators, including
+    the trajectory, performance, state, land cover and SOC outputs. The
+    three productivity sub-indicators are first combined into a single
+    productivity degradation layer, which is then combined with land cover
+    and SOC degradation using the one-out-all-out rule.
+
+    If area_summary is True, the area (in sq km) that is degraded, stable
+    and improved is also computed, using one grouped reduction at the given
+    scale (in meters), and is returned in the metadata of the indicator band
+    under 'area_summary'. This is an interactive request, so it is off by
+    default and should only be used for AOIs small enough to reduce within
+    the GEE interactive time limit. For large AOIs, export the indicator and
+    use the band summaries of TEImage.export instead.
+    """
+    logger.debug("Entering sdg_15_3_1 function.")
+    geom = ee.Geometry.Polygon(geometry)
+
+    traj = _select_band(sub_indicators, "Productivity trajectory (significance)")
+    perf = _select_band(sub_indicators, "Productivity performance (degradation)")
+    state = _select_band(sub_indicators, "Productivity state (degradation)")
+    lc_deg = _select_band(sub_indicators, "Land cover (degradation)")
+    soc_pch = _select_band(sub_indicators, "Soil organic carbon (degradation)")
+
+    # Combine productivity: a significant trajectory decides the class,
+    # except that a stable trajectory with a state decline (of 2 or more
+    # classes) is degraded, as is an improving trajectory where both state
+    # and performance show degradation. This follows the combination of the
+    # productivity sub-indicators in the UNCCD Good Practice Guidance for
+    # SDG Indicator 15.3.1 (Sims et al., 2017, section 4.2), as implemented
+    # in Trends.Earth.
+    prod_valid = traj.neq(-32768).And(state.neq(-32768)).And(perf.neq(-32768))
+    prod_deg = ee.Image(-32768) \
+        .where(prod_valid.And(traj.gte(1)), 1) \
+        .where(prod_valid.And(traj.eq(0)), 0) \
+        .where(prod_valid.And(traj.lte(-1)), -1) \
+        .where(prod_valid.And(traj.eq(0)).And(state.lte(-2)), -1) \
+        .where(prod_valid.And(traj.gte(1)).And(state.lte(-2)).And(perf.eq(-1)), -1)
+
+    # SOC is degraded (improved) where it has decreased (increased) by more
+    # than soc_threshold percent over the period
+    soc_valid = soc_pch.neq(-32768)
+    soc_deg = ee.Image(-32768) \
+        .where(soc_valid, 0) \
+        .where(soc_valid.And(soc_pch.lte(-soc_threshold)), -1) \
+        .where(soc_valid.And(soc_pch.gte(soc_threshold)), 1)
+
+    # One out, all out: degradation in any sub-indicator means degradation.
+    # Otherwise, improvement in any sub-indicator means improvement.
+    valid = prod_deg.neq(-32768).And(lc_deg.neq(-32768)).And(soc_deg.neq(-32768))
+    any_improved = prod_deg.eq(1).Or(lc_deg.eq(1)).Or(soc_deg.eq(1))
+    any_degraded = prod_deg.eq(-1).Or(lc_deg.eq(-1)).Or(soc_deg.eq(-1))
+    sdg = ee.Image(-32768) \
+        .where(valid, 0) \
+        .where(valid.And(any_improved), 1) \
+        .where(valid.And(any_degraded), -1)
+
+    metadata = {}
+    if area_summary:
+        logger.debug("Computing area summary.")
+        areas = ee.Image.pixelArea().divide(1e6) \
+            .addBands(sdg.updateMask(valid)) \
+            .reduceRegion(reducer=ee.Reducer.sum().group(groupField=1, groupName='class'),
+                          geometry=geom, scale=scale, maxPixels=1e13)
+        class_names = {-1: 'degraded', 0: 'stable', 1: 'improved'}
+        summary = {'degraded': 0, 'stable': 0, 'improved': 0}
+        for group in areas.getInfo()['groups']:
+            summary[class_names[int(group['class'])]] = group['sum']
+        metadata = {'area_summary': summary,
+                    'area_units': 'sq km',
+                    'scale': scale}
+
+    logger.debug("Setting up output.")
+    out = TEImage(sdg.addBands(prod_deg).addBands(soc_deg).clip(geom).unmask(-32768).int16(),
+                  [BandInfo("SDG 15.3.1 Indicator", add_to_map=True,
+                            metadata=metadata),
+                   BandInfo("Land productivity (degradation)"),
+                   BandInfo("Soil organic carbon (degradation, 3 class)",
+                            metadata={'threshold': soc_threshold})],
+                  storage=[plan_storage(-1, 1, categorical=True)] * 3)
+    return out
@@ -5,11 +5,12 @@ from __future__ import print_function
 import ee
 
 from landdegradation import stats, GEEIOError
-from landdegradation.util import TEImage
+from landdegradation.util import TEImage, plan_storage
+from landdegradation.land_cover import load_lc
 from landdegradation.schemas.schemas import BandInfo
 
-def management_quality(year, lu_matrix, geometry, EXECUTION_ID,logger):
-    logger.debug("Entering management quality function.")
+def management_quality_index(year, lu_matrix, geometry, logger, lc=None):
+    """Calculate the (unclassified) management quality index."""
 
     lu_remap_matrix =  [
         [
@@ -20,9 +21,8 @@ def management_quality(year, lu_matrix, geometry, EXECUTION_ID,logger):
     ]
 
     ## land cover
-    lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018").clip(geometry)
-    lc = lc.where(lc.eq(9999), -32768)
-    lc = lc.updateMask(lc.neq(-32768))
+    if lc is None:
+        lc = load_lc(geometry)
 
     # DEFINE LAND USE INTENSITY
     # Remap LC according to input matrix
@@ -66,17 +66,22 @@ def management_quality(year, lu_matrix, geometry, EXECUTION_ID,logger):
         }
     ).rename("Management Quality Index")
 
-    mqi_range = mqi \
+    return mqi
+
+
+def management_quality_classes(mqi):
+    """Classify the management quality index into 3 classes."""
+    return mqi \
         .where(mqi.lte(1.25), 1) \
         .where(mqi.lte(1.50).And(mqi.gt(1.25)), 2) \
         .where(mqi.gt(1.50), 3)
 
-    return TEImage(mqi_range.clip(geometry),
-        [BandInfo("Management Quality Index", add_to_map=True, metadata={'year':year})])
-
-
-    
-
-
 
+def management_quality(year, lu_matrix, geometry, EXECUTION_ID,logger):
+    logger.debug("Entering management quality function.")
+    mqi = management_quality_index(year, lu_matrix, geometry, logger)
+    mqi_range = management_quality_classes(mqi)
 
+    return TEImage(mqi_range.clip(geometry),
+        [BandInfo("Management Quality Index", add_to_map=True, metadata={'year':year})],
+        storage=[plan_storage(1, 3, categorical=True)])
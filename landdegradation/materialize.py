@@ -0,0 +1,295 @@
+"""
+Materialization of reusable intermediate products.
+
+Intermediates that are expensive to compute and shared by many jobs (for
+example the remapped land cover stack or the soil quality index for a given
+set of parameters) can be declared with materialized. The first time an
+intermediate is needed for a set of parameters it is exported to a
+persistent store, and later graphs read it from the store instead of
+recomputing it. The stored layers are tracked in a catalog, keyed by a hash
+of the name of the intermediate and its parameters.
+
+Materialization is off until a store is set with configure (or with the
+LANDDEGRADATION_STORE environment variable, giving an EE asset folder), in
+which case materialized simply builds the image.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import datetime
+
+import ee
+
+from landdegradation import GEEIOError
+from landdegradation.util import gee_task, TASK_TIMEOUT_MINUTES
+
+# Default location of the catalog file
+CATALOG_PATH = os.path.join(os.path.expanduser('~'), '.landdegradation',
+                            'catalog.json')
+
+
+# Lock shared by all catalogs, so that updates from concurrent jobs in this
+# process are not lost
+_catalog_lock = threading.Lock()
+
+
+def param_hash(name, params):
+    "Hash of the name of an intermediate and its (JSON serializable) params"
+    key = json.dumps({'name': name, 'params': params}, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class Catalog(object):
+    """Catalog of materialized layers, kept in a JSON file
+
+    The catalog maps parameter hashes to records with the name and params
+    of the intermediate, the location of the layer in the store, and its
+    status: 'pending' while the layer is being written, then 'complete'.
+    """
+
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        self.lock = _catalog_lock
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _save(self, records):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Write to a unique temporary file then rename, so the catalog is
+        # never read partly written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(records, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key):
+        with self.lock:
+            return self._load().get(key)
+
+    def put(self, key, record):
+        with self.lock:
+            records = self._load()
+            records[key] = record
+            self._save(records)
+
+    def remove(self, key):
+        with self.lock:
+            records = self._load()
+            if records.pop(key, None) is not None:
+                self._save(records)
+
+
+class Store(object):
+    """Interface of a store of materialized layers"""
+
+    def location(self, name, key):
+        "Return the location of a layer in the store"
+        raise NotImplementedError
+
+    def exists(self, location):
+        "Return True if a complete layer is stored at location"
+        raise NotImplementedError
+
+    def read(self, location):
+        "Return the stored layer as an ee.Image"
+        raise NotImplementedError
+
+    def write(self, image, location, region, proj, logger, wait=False):
+        """Write image to location, over region on the grid of proj
+
+        If wait is False the write is only started, and nothing is left
+        running in this process. If wait is True, returns when the layer is
+        written.
+        """
+        raise NotImplementedError
+
+
+class AssetStore(Store):
+    "Store of materialized layers in an Earth Engine asset folder"
+
+    def __init__(self, folder):
+        self.folder = folder.rstrip('/')
+
+    def location(self, name, key):
+        return '{}/{}_{}'.format(self.folder, name, key)
+
+    def exists(self, location):
+        try:
+            return ee.data.getInfo(location) is not None
+        except ee.EEException:
+            return False
+
+    def read(self, location):
+        return ee.Image(location)
+
+    def write(self, image, location, region, proj, logger, wait=False):
+        proj_info = proj.getInfo()
+        export = {'image': image,
+                  'description': location.split('/')[-1],
+                  'assetId': location,
+                  'maxPixels': 1e13,
+                  'crs': proj_info['crs'],
+                  'region': region}
+        if proj_info.get('transform'):
+            export['crsTransform'] = proj_info['transform']
+        else:
+            export['scale'] = ee.Number(proj.nominalScale()).getInfo()
+        task = ee.batch.Export.image.toAsset(**export)
+        if wait:
+            gee_task(task, location, logger, indicator='materialize').join()
+        else:
+            # The export runs on GEE without being monitored here, and is
+            # found complete by a later materialized call
+            task.start()
+
+
+class LocalStore(Store):
+    """Local stand-in for a store of materialized layers
+
+    The serialized graph of each layer is written to a directory, and read
+    back as an equivalent ee.Image. Nothing is precomputed, so this is for
+    developing and testing pipelines without writing assets.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, name, key):
+        return os.path.join(self.path, '{}_{}.json'.format(name, key))
+
+    def exists(self, location):
+        return os.path.exists(location)
+
+    def read(self, location):
+        with open(location) as f:
+            return ee.Image(ee.deserializer.fromJSON(f.read()))
+
+    def write(self, image, location, region, proj, logger, wait=False):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(location, 'w') as f:
+            f.write(image.clip(_geometry(region)).serialize())
+
+
+def _geometry(region):
+    "ee.Geometry from polygon coordinates or a GeoJSON geometry"
+    if isinstance(region, dict):
+        return ee.Geometry(region)
+    return ee.Geometry.Polygon(region)
+
+
+# Default store and catalog, set with configure
+_config = {'store': None, 'catalog': None, 'wait': False}
+
+
+def configure(store=None, catalog=None, wait=False):
+    """
+    Set the default store and catalog used by materialized.
+
+    store is a Store (or the name of an EE asset folder, for an AssetStore),
+    or None to turn materialization off. catalog defaults to a Catalog at
+    CATALOG_PATH. If wait is True, materialized waits for new layers to be
+    written and reads them from the store. Otherwise the write is started
+    (and runs on GEE, without keeping this process alive) while the current
+    job uses the computed image.
+    """
+    if isinstance(store, str):
+        store = AssetStore(store)
+    _config['store'] = store
+    _config['catalog'] = catalog if catalog is not None else Catalog()
+    _config['wait'] = wait
+
+
+def _default_catalog():
+    if _config['catalog'] is None:
+        _config['catalog'] = Catalog()
+    return _config['catalog']
+
+
+def _default_store():
+    if _config['store'] is None and os.environ.get('LANDDEGRADATION_STORE'):
+        configure(os.environ['LANDDEGRADATION_STORE'])
+    return _config['store']
+
+
+def materialized(name, params, build, region, proj, logger, store=None,
+                 catalog=None):
+    """
+    Return an intermediate image, reading it from the store if possible.
+
+    name identifies the intermediate and params (a JSON serializable dict)
+    the parameters it is built from. build is a function of no arguments
+    returning the ee.Image. region (a list of polygon coordinates, a GeoJSON
+    geometry or an ee.Geometry) and proj (an ee.Projection, or a function of
+    no arguments returning one, so that it is only computed when
+    materializing) set the extent and grid the layer is stored on, and are
+    part of the catalog key together with name and params.
+
+    If the layer is in the catalog and the store it is read from there.
+    While another job is writing it (its record is pending, for less than
+    the GEE task timeout) it is built without starting a second write.
+    Otherwise it is built and written to the store for later jobs. If no
+    store is given or configured, the image is built and returned.
+    """
+    if store is None:
+        store = _default_store()
+    if store is None:
+        return build()
+    if catalog is None:
+        catalog = _default_catalog()
+
+    if isinstance(region, ee.Geometry):
+        region = region.getInfo()
+    if callable(proj):
+        proj = proj()
+    key = param_hash(name, {'params': params, 'region': region,
+                            'proj': proj.getInfo()})
+    record = catalog.get(key)
+    if record:
+        if store.exists(record['location']):
+            if record.get('status') != 'complete':
+                record['status'] = 'complete'
+                catalog.put(key, record)
+            logger.debug("Reading materialized {} from {}.".format(name, record['location']))
+            return store.read(record['location'])
+        created = datetime.datetime.strptime(record['created'], '%Y-%m-%dT%H:%M:%S.%f')
+        age_minutes = (datetime.datetime.utcnow() - created).total_seconds() / 60
+        if record.get('status') == 'pending' and age_minutes < TASK_TIMEOUT_MINUTES:
+            logger.debug("{} is being materialized to {}, computing it.".format(name, record['location']))
+            return build()
+
+    location = store.location(name, key)
+    logger.debug("Materializing {} to {}.".format(name, location))
+    image = build()
+    record = {'name': name,
+              'params': params,
+              'location': location,
+              'status': 'pending',
+              'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    catalog.put(key, record)
+    store.write(image, location, region, proj, logger, wait=_config['wait'])
+    if _config['wait']:
+        if not store.exists(location):
+            raise GEEIOError("Failed to materialize {} to {}".format(name, location))
+        record['status'] = 'complete'
+        catalog.put(key, record)
+        return store.read(location)
+    return image
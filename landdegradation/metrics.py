@@ -0,0 +1,332 @@
+"""
+Metrics for GEE tasks run by the export machinery.
+
+gee_task reports the queue wait, run time, EECU usage, output size and
+outcome of each task to a metrics sink. The default sink keeps the metrics
+in memory in Prometheus text format. It can also write them to a file (for
+the node exporter textfile collector) or serve them over HTTP, either when
+configured in code or through the LANDDEGRADATION_METRICS_FILE and
+LANDDEGRADATION_METRICS_PORT environment variables. Other monitoring
+systems can be used by passing a MetricsSink to set_sink.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import tempfile
+import threading
+
+# Histogram buckets (upper bounds) for task durations, in seconds
+DURATION_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 12 * 3600,
+                    24 * 3600, 48 * 3600)
+
+# Failure reasons used as metric labels, matched against the error message
+# of a failed task. Messages matching none of these are counted as 'other'.
+FAILURE_REASONS = (('too many pixels', 'too_many_pixels'),
+                   ('memory', 'memory'),
+                   ('timed out', 'timeout'),
+                   ('cancel', 'cancelled'),
+                   ('quota', 'quota'),
+                   ('permission', 'permission'))
+
+
+def failure_reason(error_message):
+    "Short label for the error message of a failed task"
+    msg = (error_message or '').lower()
+    for match, reason in FAILURE_REASONS:
+        if match in msg:
+            return reason
+    return 'other'
+
+
+class MetricsSink(object):
+    """Interface of a destination for metrics
+
+    Counters only increase, with inc. Histograms record the distribution of
+    observed values, with observe. labels is a dict of label names and
+    values.
+    """
+
+    def inc(self, name, value=1, labels=None):
+        raise NotImplementedError
+
+    def observe(self, name, value, labels=None):
+        raise NotImplementedError
+
+    def total(self, name, labels=None, exclude=None):
+        """Return the value of a counter, or the sum of a histogram, summed
+        over all series matching labels, and matching none of the label
+        values in exclude. Returns None if nothing was recorded."""
+        return None
+
+
+class NullSink(MetricsSink):
+    "Sink that discards all metrics"
+
+    def inc(self, name, value=1, labels=None):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _excluded(key, exclude):
+    return any(item in key for item in (exclude or {}).items())
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in items) + '}'
+
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _number(text):
+    value = float(text)
+    if value.is_integer():
+        return int(value)
+    return value
+
+
+class PrometheusSink(MetricsSink):
+    """Sink keeping metrics in memory, exposed in Prometheus text format
+
+    If path is given the metrics are rewritten to that file after every
+    update, and the metrics already in the file (for example from earlier
+    runs) are loaded first. If port is given they are served over HTTP on
+    that port.
+    """
+
+    def __init__(self, path=None, port=None, buckets=DURATION_BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self.lock = threading.RLock()
+        self.counters = {}
+        self.histograms = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.load(f.read())
+        if port is not None:
+            self.serve(port)
+
+    def inc(self, name, value=1, labels=None):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + value
+        self._write()
+
+    def observe(self, name, value, labels=None):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = _label_key(labels)
+            h = series.setdefault(key, {'buckets': [0] * len(self.buckets),
+                                        'sum': 0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h['buckets'][i] += 1
+            h['sum'] += value
+            h['count'] += 1
+        self._write()
+
+    def total(self, name, labels=None, exclude=None):
+        match = set(_label_key(labels))
+        with self.lock:
+            if name in self.counters:
+                values = [v for k, v in self.counters[name].items()
+                          if match.issubset(k) and not _excluded(k, exclude)]
+            elif name in self.histograms:
+                values = [h['sum'] for k, h in self.histograms[name].items()
+                          if match.issubset(k) and not _excluded(k, exclude)]
+            else:
+                return None
+        if not values:
+            return None
+        return sum(values)
+
+    def render(self):
+        "Return all metrics in Prometheus text exposition format"
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append('{}{} {}'.format(name, _format_labels(key), value))
+            for name in sorted(self.histograms):
+                lines.append('# TYPE {} histogram'.format(name))
+                for key, h in sorted(self.histograms[name].items()):
+                    for bound, count in zip(self.buckets, h['buckets']):
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(key, [('le', bound)]), count))
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(key, [('le', '+Inf')]), h['count']))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(key), h['sum']))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(key), h['count']))
+        return '\n'.join(lines) + '\n'
+
+    def load(self, text):
+        """Add the metrics in text, in Prometheus text format as written by
+        render, to the metrics of the sink
+
+        Histograms with buckets other than those of the sink are skipped.
+        """
+        types = {}
+        samples = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith('# TYPE '):
+                _, _, name, kind = line.split()
+                types[name] = kind
+            elif line and not line.startswith('#'):
+                m = _SAMPLE_RE.match(line)
+                if m:
+                    labels = dict((k, _unescape(v)) for k, v in _LABEL_RE.findall(m.group(2) or ''))
+                    samples.append((m.group(1), labels, _number(m.group(3))))
+
+        loaded = {}
+        for name, labels, value in samples:
+            if types.get(name) == 'counter':
+                loaded.setdefault(name, {})[_label_key(labels)] = ('counter', value)
+                continue
+            for suffix in ('_bucket', '_sum', '_count'):
+                base = name[:-len(suffix)]
+                if name.endswith(suffix) and types.get(base) == 'histogram':
+                    le = labels.pop('le', None)
+                    h = loaded.setdefault(base, {}).setdefault(
+                        _label_key(labels), ('histogram', {'buckets': {}, 'sum': 0, 'count': 0}))[1]
+                    if suffix == '_bucket':
+                        if le != '+Inf':
+                            h['buckets'][float(le)] = value
+                    else:
+                        h[suffix[1:]] = value
+                    break
+
+        with self.lock:
+            for name, series in loaded.items():
+                for key, (kind, value) in series.items():
+                    if kind == 'counter':
+                        counter = self.counters.setdefault(name, {})
+                        counter[key] = counter.get(key, 0) + value
+                        continue
+                    if sorted(value['buckets']) != [float(b) for b in self.buckets]:
+                        continue
+                    h = self.histograms.setdefault(name, {}).setdefault(
+                        key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+                    for i, bound in enumerate(self.buckets):
+                        h['buckets'][i] += value['buckets'][float(bound)]
+                    h['sum'] += value['sum']
+                    h['count'] += value['count']
+
+    def _write(self):
+        if not self.path:
+            return
+        # Write to a unique temporary file then rename, so a collector never
+        # reads a partial file, and hold the lock so that concurrent updates
+        # are written in order
+        with self.lock:
+            text = self.render()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                            suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+
+    def serve(self, port):
+        "Serve the metrics over HTTP on port, from a background thread"
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('', port), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def set_sink(sink):
+    "Set the sink that metrics are reported to"
+    global _sink
+    with _sink_lock:
+        _sink = sink
+
+
+def get_sink():
+    "Return the metrics sink, creating the default PrometheusSink if needed"
+    global _sink
+    # gee_task threads report concurrently, so only one of them may create
+    # the sink (and bind its port)
+    with _sink_lock:
+        if _sink is None:
+            port = os.environ.get('LANDDEGRADATION_METRICS_PORT')
+            _sink = PrometheusSink(path=os.environ.get('LANDDEGRADATION_METRICS_FILE'),
+                                   port=int(port) if port else None)
+        return _sink
+
+
+def record_task(status, indicator, state, reason=None):
+    """
+    Record the metrics of a finished GEE task from its status.
+
+    status is the dict returned by ee task status(). state is the final
+    state of the task ('COMPLETED', 'FAILED', ...) and reason the failure
+    reason label, if it failed.
+    """
+    sink = get_sink()
+    labels = {'indicator': indicator}
+    outcome = {'indicator': indicator, 'state': state}
+    if reason is not None:
+        outcome['reason'] = reason
+    sink.inc('gee_task_total', labels=outcome)
+
+    created = status.get('creation_timestamp_ms')
+    started = status.get('start_timestamp_ms')
+    updated = status.get('update_timestamp_ms')
+    if created and started:
+        sink.observe('gee_task_queue_seconds', (started - created) / 1000, labels)
+    if started and updated:
+        sink.observe('gee_task_run_seconds', (updated - started) / 1000, labels)
+    if status.get('batch_eecu_usage_seconds') is not None:
+        sink.inc('gee_task_eecu_seconds_total',
+                 status['batch_eecu_usage_seconds'], labels)
+
+
+def record_output(indicator, n_files, n_bytes):
+    "Record the number and total size of the files written by a task"
+    sink = get_sink()
+    labels = {'indicator': indicator}
+    sink.inc('gee_task_output_files_total', n_files, labels)
+    sink.inc('gee_task_output_bytes_total', n_bytes, labels)
@@ -1,18 +1,31 @@
 import ee
 
 
-def modis_ndvi_annual_integral(year_start, year_end):
+def modis_ndvi_annual_integral(year_start, year_end, start_month=1,
+                               start_day=1, months=12):
     """Calculate annual trend of integrated NDVI.
 
     Calculates the trend of annual integrated NDVI using NDVI data from the
     MODIS Collection 6 MOD13Q1 dataset. Areas where changes are not significant
     are masked out using a Mann-Kendall test.
 
+    The NDVI is aggregated over one period per year, starting on start_month
+    and start_day of each year and lasting the given number of months. The
+    default is the calendar year, but a growing season (for example
+    start_month=4, months=6) or a hydrological year (start_month=10,
+    months=12) can be used instead. Each period is labelled with the year it
+    starts in. The aggregation is done on the server, mapping over the list
+    of years, so the size of the request does not grow with the length of
+    the series.
+
     Args:
         year_start: The starting year (to define the period the trend is
             calculated over).
         year_end: The ending year (to define the period the trend is
             calculated over).
+        start_month: The month each aggregation period starts in.
+        start_day: The day of the month each aggregation period starts on.
+        months: The length of each aggregation period in months.
 
     Returns:
         Google Earth Engine image collection
@@ -21,25 +34,24 @@ def modis_ndvi_annual_integral(year_start, year_end):
     # Load a MODIS NDVI collection 6 MODIS/MOD13Q1
     modis_16d_o = ee.ImageCollection('MODIS/006/MOD13Q1')
 
-    # Function to mask pixels based on quality flags
+    # Function to mask pixels based on quality flags: only good (0) and
+    # marginal (1) quality pixels are kept
     def qa_filter(img):
-        mask = img.select('SummaryQA')
-        mask = mask.where(img.select('SummaryQA').eq(-1), 0)
-        mask = mask.where(img.select('SummaryQA').eq(0), 1)
-        mask = mask.where(img.select('SummaryQA').eq(1), 1)
-        mask = mask.where(img.select('SummaryQA').eq(2), 0)
-        mask = mask.where(img.select('SummaryQA').eq(3), 0)
+        mask = img.select('SummaryQA').remap([0, 1], [1, 1], 0)
         masked = img.select('NDVI').updateMask(mask)
         return masked
 
-    # Function to integrate observed NDVI datasets at the annual level
+    # Function to integrate observed NDVI datasets over each annual period
     def int_16d_1yr_o(ndvi_coll):
-        img_coll = ee.List([])
-        for k in range(year_start, year_end):
-            ndvi_img = ndvi_coll.select('NDVI').filterDate('{}-01-01'.format(k), '{}-12-31'.format(k)).reduce(ee.Reducer.mean()).multiply(0.0001)
-            img = ndvi_img.addBands(ee.Image(k).float()).rename(['ndvi', 'year']).set({'year': k})
-            img_coll = img_coll.add(img)
-        return ee.ImageCollection(img_coll)
+        def period_mean(k):
+            k = ee.Number(k)
+            start = ee.Date.fromYMD(k, start_month, start_day)
+            ndvi_img = ndvi_coll.filterDate(start, start.advance(months, 'month')) \
+                .reduce(ee.Reducer.mean()).multiply(0.0001)
+            return ndvi_img.addBands(ee.Image.constant(k).float()) \
+                .rename(['ndvi', 'year']).set({'year': k})
+        years = ee.List.sequence(year_start, year_end - 1)
+        return ee.ImageCollection.fromImages(years.map(period_mean))
 
     # Filter modis collection using the quality filter
     modis_16d_o = modis_16d_o.map(qa_filter)
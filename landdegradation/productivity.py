@@ -6,6 +6,7 @@ import ee
 
 from landdegradation import stats, GEEIOError
 from landdegradation.util import TEImage
+from landdegradation.land_cover import load_lc
 from landdegradation.schemas.schemas import BandInfo
 
 def fetchNDVI():
@@ -25,6 +26,23 @@ def fetchNDVI():
 
     return multiband_renamed
 
+def load_ndvi(ndvi_gee_dataset, area):
+    """Load annual NDVI integrals clipped to area, with nodata masked.
+
+    The returned stack can be shared between the productivity sub-indicators
+    so that the NDVI dataset is only loaded, clipped and masked once per AOI.
+    """
+    if(ndvi_gee_dataset == 'users/miswagrace/ndvi_landsat_1999_2020'):
+        ndvi_gee_dataset = fetchNDVI()
+        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area).multiply(10000)
+    else:
+        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area)
+
+    ndvi_1yr = ndvi_1yr.where(ndvi_1yr.eq(9999), -32768)
+    ndvi_1yr = ndvi_1yr.updateMask(ndvi_1yr.neq(-32768))
+
+    return ndvi_1yr
+
 def ndvi_trend(year_start, year_end, ndvi_1yr, logger):
     """Calculate temporal NDVI analysis.
     Calculates the trend of temporal NDVI using NDVI data from the
@@ -59,75 +77,94 @@ def ndvi_trend(year_start, year_end, ndvi_1yr, logger):
     return (lf_trend, mk_trend)
 
 
-def p_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger):
-    logger.debug("Entering p_restrend function.")
+def _restrend(year_start, year_end, ndvi_1yr, climate_1yr, n_calib):
+    """Per pixel RESTREND with array regression.
 
-    def f_img_coll(ndvi_stack):
-        img_coll = ee.List([])
-        for k in range(year_start, year_end + 1):
-            ndvi_img = ndvi_stack.select('y{}'.format(k))\
-                .addBands(climate_1yr.select('y{}'.format(k)))\
-                .rename(['ndvi', 'clim']).set({'year': k})
-            img_coll = img_coll.add(ndvi_img)
-        return ee.ImageCollection(img_coll)
-
-    ## Function to predict NDVI from climate
-    first = ee.List([])
-
-    def f_ndvi_clim_p(image, list):
-        ndvi = lf_clim_ndvi.select('offset').add((lf_clim_ndvi.select('scale').multiply(image))).set({'year': image.get('year')})
-        return ee.List(list).add(ndvi)
+    NDVI is regressed on climate over the first n_calib years, the fit is
+    used to predict NDVI over the whole period, and a linear trend and the
+    Mann-Kendall statistic are computed on the residuals. Each year's bands
+    are stacked into one n x 1 array per pixel, so that the climate fit,
+    residuals and residual trend are computed in one array pipeline rather
+    than with a filter per year.
 
-    ## Function to compute residuals (ndvi obs - ndvi pred)
-    def f_ndvi_clim_r_img(year):
-        ndvi_o = ndvi_1yr_coll.filter(ee.Filter.eq('year', year)).select('ndvi').median()
-        ndvi_p = ndvi_1yr_p.filter(ee.Filter.eq('year', year)).median()
-        ndvi_r = ee.Image(year).float().addBands(ndvi_o.subtract(ndvi_p))
-        return ndvi_r.rename(['year', 'ndvi_res'])
-
-    # Function to compute differences between observed and predicted NDVI and compilation in an image collection
-    def stack(year_start, year_end):
-        img_coll = ee.List([])
-        for k in range(year_start, year_end + 1):
-            ndvi = ndvi_1yr_o.filter(ee.Filter.eq('year', k)).select('ndvi').median()
-            clim = clim_1yr_o.filter(ee.Filter.eq('year', k)).select('ndvi').median()
-            img = ndvi.addBands(clim.addBands(ee.Image(k).float())).rename(['ndvi', 'clim', 'year']).set({'year': k})
-            img_coll = img_coll.add(img)
-        return ee.ImageCollection(img_coll)
+    Years where NDVI or climate is missing for a pixel are left out of the
+    fits and of the Mann-Kendall statistic for that pixel, by zeroing their
+    rows. Pixels with fewer than 3 valid years in the calibration period or
+    in the full period are masked.
+    """
+    years = list(range(year_start, year_end + 1))
+    n = len(years)
+    bands = ['y{}'.format(k) for k in years]
+
+    # n x 1 array of 1 for years where both NDVI and climate are valid, as
+    # toArray masks a pixel that is missing any one of the years
+    ndvi_bands = ndvi_1yr.select(bands)
+    clim_bands = climate_1yr.select(bands)
+    valid = ndvi_bands.mask().And(clim_bands.mask()).toArray().toArray(1)
+    n_valid = valid.arrayReduce(ee.Reducer.sum(), [0]).arrayGet([0, 0])
+    n_valid_calib = valid.arraySlice(0, 0, n_calib) \
+        .arrayReduce(ee.Reducer.sum(), [0]).arrayGet([0, 0])
+
+    # n x 1 arrays of the observations, and n x 2 design matrices with a
+    # column of ones for the offset, with the rows of missing years zeroed
+    ndvi = ndvi_bands.unmask(0).toArray().toArray(1).multiply(valid)
+    clim = clim_bands.unmask(0).toArray().toArray(1)
+    ones = ee.Image(ee.Array([[1]] * n))
+    valid_2 = valid.arrayRepeat(1, 2)
+    x_clim = ones.arrayCat(clim, 1).multiply(valid_2)
+    x_year = ee.Image(ee.Array([[1, k] for k in years])).multiply(valid_2)
+
+    ## Fit NDVI to climate over the calibration years
+    clim_coefs = x_clim.arraySlice(0, 0, n_calib) \
+        .matrixSolve(ndvi.arraySlice(0, 0, n_calib))
+
+    ## Residuals of the NDVI predicted from climate over the whole period
+    ## (zero for missing years)
+    ndvi_res = ndvi.subtract(x_clim.matrixMultiply(clim_coefs))
 
-    ## Function create image collection of residuals
-    def f_ndvi_clim_r_coll(year_start, year_end):
-        res_list = ee.List([])
-        #for(i = year_start i <= year_end i += 1):
-        for i in range(year_start, year_end + 1):
-            res_image = f_ndvi_clim_r_img(i)
-            res_list = res_list.add(res_image)
-        return ee.ImageCollection(res_list)
+    ## Fit a linear regression to the NDVI residuals
+    res_coefs = x_year.matrixSolve(ndvi_res)
+    lf_trend = res_coefs.arrayGet([0, 0]) \
+        .addBands(res_coefs.arrayGet([1, 0])) \
+        .rename(['offset', 'scale'])
 
-    ## Apply function to create image collection of ndvi and climate
-    ndvi_1yr_coll = f_img_coll(ndvi_1yr)
+    ## Compute Kendall statistics
+    mk_trend = stats.mann_kendall_array(ndvi_res, n, valid)
 
-    ## Compute linear trend function to predict ndvi based on climate (independent are followed by dependent var
-    lf_clim_ndvi = ndvi_1yr_coll.select(['clim', 'ndvi']).reduce(ee.Reducer.linearFit())
+    enough = n_valid.gte(3).And(n_valid_calib.gte(3))
+    return (lf_trend.updateMask(enough), mk_trend.updateMask(enough))
 
-    ## Apply function to  predict NDVI based on climate
-    ndvi_1yr_p = ee.ImageCollection(ee.List(ndvi_1yr_coll.select('clim').iterate(f_ndvi_clim_p, first)))
 
-    ## Apply function to compute NDVI annual residuals
-    ndvi_1yr_r = f_ndvi_clim_r_coll(year_start, year_end)
+def p_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger):
+    """Residual trend (RESTREND) of NDVI after accounting for climate.
 
-    ## Fit a linear regression to the NDVI residuals
-    lf_trend = ndvi_1yr_r.select(['year', 'ndvi_res']).reduce(ee.Reducer.linearFit())
+    NDVI is fit to climate over the whole period.
+    """
+    logger.debug("Entering p_restrend function.")
+    return _restrend(year_start, year_end, ndvi_1yr, climate_1yr,
+                     year_end - year_start + 1)
 
-    ## Compute Kendall statistics
-    mk_trend = stats.mann_kendall(ndvi_1yr_r.select('ndvi_res'))
 
-    return (lf_trend, mk_trend)
+def s_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger,
+               calib_years=None):
+    """Baseline-calibrated RESTREND of NDVI after accounting for climate.
 
+    NDVI is fit to climate over a baseline made up of the first calib_years
+    of the period (by default the first half, and at least 3 years), and
+    the fit is applied over the full period. Degradation after the baseline
+    then shows in the residual trend, rather than being absorbed by the
+    climate fit.
 
-def s_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger):
-    #TODO: Copy this code over
+    Note this is not the breakpoint-based S-RESTREND of Burrell et al.
+    (2017): no breakpoint is detected, and the baseline is fixed.
+    """
     logger.debug("Entering s_restrend function.")
+    n = year_end - year_start + 1
+    if calib_years is None:
+        calib_years = max(3, n // 2)
+    if calib_years < 3 or calib_years > n:
+        raise GEEIOError("Calibration period of {} years must be between 3 years and the length of the period".format(calib_years))
+    return _restrend(year_start, year_end, ndvi_1yr, climate_1yr, calib_years)
 
 
 def ue_trend(year_start, year_end, ndvi_1yr, climate_1yr, logger):
@@ -158,9 +195,40 @@ def ue_trend(year_start, year_end, ndvi_1yr, climate_1yr, logger):
     return (lf_trend, mk_trend)
 
 
+def _trajectory_bands(lf_trend, mk_trend, kendall90, kendall95, kendall99):
+    "Trend, significance and Kendall statistic bands of a trajectory method"
+    # Create final productivity trajectory output layer. Positive values are 
+    # significant increase, negative values are significant decrease.
+    signif = ee.Image(-32768) \
+        .where(lf_trend.select('scale').gt(0).And(mk_trend.abs().gte(kendall90)), 1) \
+        .where(lf_trend.select('scale').gt(0).And(mk_trend.abs().gte(kendall95)), 2) \
+        .where(lf_trend.select('scale').gt(0).And(mk_trend.abs().gte(kendall99)), 3) \
+        .where(lf_trend.select('scale').lt(0).And(mk_trend.abs().gte(kendall90)), -1) \
+        .where(lf_trend.select('scale').lt(0).And(mk_trend.abs().gte(kendall95)), -2) \
+        .where(lf_trend.select('scale').lt(0).And(mk_trend.abs().gte(kendall99)), -3) \
+        .where(mk_trend.abs().lte(kendall90), 0) \
+        .where(lf_trend.select('scale').abs().lte(10), 0)
+
+    return lf_trend.select('scale').addBands(signif).addBands(mk_trend)
+
+
 def productivity_trajectory(geometry,year_start, year_end, method, ndvi_gee_dataset,
-                            climate_gee_dataset, logger):
+                            climate_gee_dataset, logger, ndvi_1yr=None):
+    """
+    Calculate the productivity trajectory.
+
+    method is one of 'ndvi_trend', 'p_restrend', 's_restrend' or 'ue', or a
+    list of them to compare methods in one job. The NDVI and climate inputs
+    are loaded once and shared, and the output has a trend, significance and
+    Kendall statistic band for each method, in order, with the method in the
+    band metadata.
+    """
     logger.debug("Entering productivity_trajectory function.")
+    if isinstance(method, str):
+        methods = [method]
+    else:
+        methods = list(method)
+
     geom = ee.Geometry.Polygon(geometry)
     # Location
     area = ee.FeatureCollection(geom)
@@ -168,35 +236,11 @@ def productivity_trajectory(geometry,year_start, year_end, method, ndvi_gee_data
     climate_1yr = climate_1yr.where(climate_1yr.eq(9999), -32768)
     climate_1yr = climate_1yr.updateMask(climate_1yr.neq(-32768))
 
-    if climate_gee_dataset == None and method != 'ndvi_trend':
+    if climate_gee_dataset == None and any(m != 'ndvi_trend' for m in methods):
         raise GEEIOError("Must specify a climate dataset")
 
-    if(ndvi_gee_dataset == 'users/miswagrace/ndvi_landsat_1999_2020'):
-        ndvi_gee_dataset = fetchNDVI()
-        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area).multiply(10000)
-    else:
-        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area)
-
-    ndvi_1yr = ndvi_1yr.where(ndvi_1yr.eq(9999), -32768)
-    ndvi_1yr = ndvi_1yr.updateMask(ndvi_1yr.neq(-32768))
-
-    ndvi_mean = ndvi_1yr.select(ee.List(['y{}'.format(i) for i in range(year_start, year_end + 1)])) \
-        .reduce(ee.Reducer.mean()).rename(['ndvi'])
-
-    # Run the selected algorithm
-    if method == 'ndvi_trend':
-        lf_trend, mk_trend = ndvi_trend(year_start, year_end, ndvi_1yr, logger)
-    elif method == 'p_restrend':
-        lf_trend, mk_trend = p_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger)
-        if climate_1yr == None:
-            climate_1yr = precp_gpcc
-    elif method == 's_restrend':
-        #TODO: need to code this
-        raise GEEIOError("s_restrend method not yet supported")
-    elif method == 'ue':
-        lf_trend, mk_trend = ue_trend(year_start, year_end, ndvi_1yr, climate_1yr, logger)
-    else:
-        raise GEEIOError("Unrecognized method '{}'".format(method))
+    if ndvi_1yr is None:
+        ndvi_1yr = load_ndvi(ndvi_gee_dataset, area)
 
     # Define Kendall parameter values for a significance of 0.05
     period = year_end - year_start + 1
@@ -204,44 +248,47 @@ def productivity_trajectory(geometry,year_start, year_end, method, ndvi_gee_data
     kendall95 = stats.get_kendall_coef(period, 95)
     kendall99 = stats.get_kendall_coef(period, 99)
 
-    # Create final productivity trajectory output layer. Positive values are 
-    # significant increase, negative values are significant decrease.
-    signif = ee.Image(-32768) \
-        .where(lf_trend.select('scale').gt(0).And(mk_trend.abs().gte(kendall90)), 1) \
-        .where(lf_trend.select('scale').gt(0).And(mk_trend.abs().gte(kendall95)), 2) \
-        .where(lf_trend.select('scale').gt(0).And(mk_trend.abs().gte(kendall99)), 3) \
-        .where(lf_trend.select('scale').lt(0).And(mk_trend.abs().gte(kendall90)), -1) \
-        .where(lf_trend.select('scale').lt(0).And(mk_trend.abs().gte(kendall95)), -2) \
-        .where(lf_trend.select('scale').lt(0).And(mk_trend.abs().gte(kendall99)), -3) \
-        .where(mk_trend.abs().lte(kendall90), 0) \
-        .where(lf_trend.select('scale').abs().lte(10), 0)
-
-    return TEImage(lf_trend.select('scale').addBands(signif).addBands(mk_trend).clip(area).unmask(-32768).int16(),
-                   [BandInfo("Productivity trajectory (trend)", metadata={'year_start': year_start, 'year_end': year_end}),
-                    BandInfo("Productivity trajectory (significance)", add_to_map=True, metadata={'year_start': year_start, 'year_end': year_end}),
-                    BandInfo("Mean annual NDVI integral", metadata={'year_start': year_start, 'year_end': year_end})])
+    out = None
+    for method in methods:
+        # Run the selected algorithm
+        if method == 'ndvi_trend':
+            lf_trend, mk_trend = ndvi_trend(year_start, year_end, ndvi_1yr, logger)
+        elif method == 'p_restrend':
+            lf_trend, mk_trend = p_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger)
+        elif method == 's_restrend':
+            lf_trend, mk_trend = s_restrend(year_start, year_end, ndvi_1yr, climate_1yr, logger)
+        elif method == 'ue':
+            lf_trend, mk_trend = ue_trend(year_start, year_end, ndvi_1yr, climate_1yr, logger)
+        else:
+            raise GEEIOError("Unrecognized method '{}'".format(method))
+
+        bands = _trajectory_bands(lf_trend, mk_trend, kendall90, kendall95, kendall99)
+        metadata = {'year_start': year_start, 'year_end': year_end, 'method': method}
+        band_info = [BandInfo("Productivity trajectory (trend)", metadata=dict(metadata)),
+                     BandInfo("Productivity trajectory (significance)", add_to_map=True, metadata=dict(metadata)),
+                     BandInfo("Productivity trajectory (Kendall statistic)", metadata=dict(metadata))]
+        if out is None:
+            out = TEImage(bands, band_info)
+        else:
+            out.addBands(bands, band_info)
+
+    out.image = out.image.clip(area).unmask(-32768).int16()
+    return out
 
 
 def productivity_performance(geometry, year_start, year_end, ndvi_gee_dataset, geojson,
-                             EXECUTION_ID, logger):
+                             EXECUTION_ID, logger, ndvi_1yr=None, lc=None):
     logger.debug("Entering productivity_performance function.")
     geom = ee.Geometry.Polygon(geometry)
     # Location
     area = ee.FeatureCollection(geom)
 
-    if(ndvi_gee_dataset == 'users/miswagrace/ndvi_landsat_1999_2020'):
-        ndvi_gee_dataset = fetchNDVI()
-        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area).multiply(10000)
-    else:
-        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area)
-
-    ndvi_1yr = ndvi_1yr.where(ndvi_1yr.eq(9999), -32768)
-    ndvi_1yr = ndvi_1yr.updateMask(ndvi_1yr.neq(-32768))
+    if ndvi_1yr is None:
+        ndvi_1yr = load_ndvi(ndvi_gee_dataset, area)
 
     # land cover data from esa cci
-    lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018")
-    lc = lc.where(lc.eq(9999), -32768)
-    lc = lc.updateMask(lc.neq(-32768))
+    if lc is None:
+        lc = load_lc()
 
     # global agroecological zones from IIASA
     soil_tax_usda = ee.Image("users/geflanddegradation/toolbox_datasets/soil_tax_usda_sgrid")
@@ -318,17 +365,14 @@ def productivity_performance(geometry, year_start, year_end, ndvi_gee_dataset, g
 
 def productivity_state(geometry,year_bl_start, year_bl_end,
                        year_tg_start, year_tg_end,
-                       ndvi_gee_dataset, EXECUTION_ID, logger):
+                       ndvi_gee_dataset, EXECUTION_ID, logger, ndvi_1yr=None):
     logger.debug("Entering productivity_state function.")
     geom = ee.Geometry.Polygon(geometry)
     # Location
     area = ee.FeatureCollection(geom)
     
-    if(ndvi_gee_dataset == 'users/miswagrace/ndvi_landsat_1999_2020'):
-        ndvi_gee_dataset = fetchNDVI()
-        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area).multiply(10000)
-    else:
-        ndvi_1yr = ee.Image(ndvi_gee_dataset).clip(area)
+    if ndvi_1yr is None:
+        ndvi_1yr = load_ndvi(ndvi_gee_dataset, area)
 
     # compute min and max of annual ndvi for the baseline period
     bl_ndvi_range = ndvi_1yr.select(ee.List(['y{}'.format(i) for i in range(year_bl_start, year_bl_end + 1)])) \
@@ -0,0 +1,221 @@
+"""
+Local processing of rasters downloaded from cloud storage.
+
+These functions require GDAL, which is only needed on clients, so it is
+imported when first used rather than being an install requirement.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import tempfile
+
+from landdegradation import LandDegradationError
+
+
+def _gdal():
+    try:
+        from osgeo import gdal
+    except ImportError:
+        raise LandDegradationError("GDAL is required for local raster processing")
+    gdal.UseExceptions()
+    return gdal
+
+
+def _overview_levels(ds, min_size=256):
+    "Overview factors (2, 4, 8, ...) until the raster fits in min_size pixels"
+    levels = []
+    factor = 2
+    while max(ds.RasterXSize, ds.RasterYSize) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def add_overviews(path, out_path=None, levels=None, resampling='NEAREST',
+                  block_size=512, compress='DEFLATE'):
+    """
+    Add internal overviews to a GeoTIFF, writing a cloud-optimized GeoTIFF.
+
+    Use NEAREST resampling (the default) for categorical bands and AVERAGE
+    for continuous ones. If levels is not given, overviews are built by
+    factors of two down to 256 pixels. If out_path is not given the file is
+    replaced in place. Returns the path of the output file.
+    """
+    gdal = _gdal()
+    if out_path is None:
+        out_path = path
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.tif',
+                                    dir=os.path.dirname(os.path.abspath(out_path)))
+    os.close(fd)
+    try:
+        if gdal.GetDriverByName('COG') is not None and levels is None:
+            # GDAL >= 3.1 writes overviews and the COG layout in one step
+            gdal.Translate(tmp_path, path, format='COG',
+                           creationOptions=['BLOCKSIZE={}'.format(block_size),
+                                            'COMPRESS={}'.format(compress),
+                                            'OVERVIEWS=AUTO',
+                                            'RESAMPLING={}'.format(resampling),
+                                            'BIGTIFF=IF_SAFER'])
+        else:
+            # Build the overviews on a copy, then rewrite it with the
+            # overviews placed ahead of the full resolution data
+            fd, ovr_path = tempfile.mkstemp(suffix='.tif',
+                                            dir=os.path.dirname(tmp_path))
+            os.close(fd)
+            try:
+                shutil.copyfile(path, ovr_path)
+                ds = gdal.Open(ovr_path, gdal.GA_Update)
+                if levels is None:
+                    levels = _overview_levels(ds)
+                ds.BuildOverviews(resampling, levels)
+                ds = None
+                gdal.Translate(tmp_path, ovr_path, format='GTiff',
+                               creationOptions=['TILED=YES',
+                                                'BLOCKXSIZE={}'.format(block_size),
+                                                'BLOCKYSIZE={}'.format(block_size),
+                                                'COMPRESS={}'.format(compress),
+                                                'COPY_SRC_OVERVIEWS=YES',
+                                                'BIGTIFF=IF_SAFER'])
+            finally:
+                os.remove(ovr_path)
+        shutil.move(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return out_path
+
+
+def _set_band_info(ds, bands):
+    "Set band descriptions, nodata and metadata from CloudResults band info"
+    for i, band in enumerate(bands[:ds.RasterCount]):
+        rb = ds.GetRasterBand(i + 1)
+        rb.SetDescription(band.get('name', ''))
+        if band.get('no_data_value') is not None:
+            rb.SetNoDataValue(band['no_data_value'])
+        metadata = band.get('metadata') or {}
+        rb.SetMetadata(dict((str(k), v if isinstance(v, str) else json.dumps(v))
+                            for k, v in metadata.items()))
+
+
+def build_mosaic(paths, vrt_path, results=None):
+    """
+    Build a virtual mosaic (VRT) over downloaded GeoTIFF pieces.
+
+    paths can include the pieces of several files and several regions. If
+    results (the CloudResults JSON returned by TEImage.export) is given, the
+    band info in it is attached as band descriptions and metadata. No pixel
+    data is read. Returns the path of the VRT.
+    """
+    gdal = _gdal()
+    ds = gdal.BuildVRT(vrt_path, list(paths))
+    if ds is None:
+        raise LandDegradationError("Failed to build mosaic of {}".format(paths))
+    if results:
+        _set_band_info(ds, results.get('bands', []))
+    ds = None
+    return vrt_path
+
+
+def write_mosaic(src_path, out_path, block_size=1024, cache_mb=256,
+                 compress='DEFLATE'):
+    """
+    Write a mosaic (for example a VRT from build_mosaic) to a single GeoTIFF.
+
+    The data is copied in block_size windows, so memory use is bounded by
+    one window per band plus the GDAL block cache (limited to cache_mb),
+    regardless of the size of the mosaic. Band descriptions, nodata values
+    and metadata are copied to the output. Returns the output path.
+    """
+    gdal = _gdal()
+    gdal.SetCacheMax(cache_mb * 1024 * 1024)
+
+    src = gdal.Open(src_path)
+    first = src.GetRasterBand(1)
+    dst = gdal.GetDriverByName('GTiff').Create(
+        out_path, src.RasterXSize, src.RasterYSize, src.RasterCount,
+        first.DataType,
+        options=['TILED=YES',
+                 'BLOCKXSIZE=512',
+                 'BLOCKYSIZE=512',
+                 'COMPRESS={}'.format(compress),
+                 'BIGTIFF=IF_SAFER'])
+    dst.SetGeoTransform(src.GetGeoTransform())
+    dst.SetProjection(src.GetProjection())
+
+    for n in range(1, src.RasterCount + 1):
+        src_band = src.GetRasterBand(n)
+        dst_band = dst.GetRasterBand(n)
+        dst_band.SetDescription(src_band.GetDescription())
+        dst_band.SetMetadata(src_band.GetMetadata())
+        if src_band.GetNoDataValue() is not None:
+            dst_band.SetNoDataValue(src_band.GetNoDataValue())
+
+    for y in range(0, src.RasterYSize, block_size):
+        rows = min(block_size, src.RasterYSize - y)
+        for x in range(0, src.RasterXSize, block_size):
+            cols = min(block_size, src.RasterXSize - x)
+            for n in range(1, src.RasterCount + 1):
+                data = src.GetRasterBand(n).ReadAsArray(x, y, cols, rows)
+                dst.GetRasterBand(n).WriteArray(data, x, y)
+        dst.FlushCache()
+
+    dst = None
+    src = None
+    return out_path
+
+
+def assemble(paths, out_path, results=None, vrt_path=None, **kwargs):
+    """
+    Assemble downloaded pieces of an export into one mosaic.
+
+    A VRT is always built (at vrt_path, or next to out_path). If out_path
+    ends in .vrt the VRT is the output, otherwise a single GeoTIFF is
+    written from it with write_mosaic (passing kwargs along). Returns the
+    path of the output.
+    """
+    if out_path.lower().endswith('.vrt'):
+        return build_mosaic(paths, out_path, results)
+    if vrt_path is None:
+        vrt_path = os.path.splitext(out_path)[0] + '.vrt'
+    build_mosaic(paths, vrt_path, results)
+    return write_mosaic(vrt_path, out_path, **kwargs)
+
+
+def write_arrays(out_path, arrays, geotransform, crs, band_info=None,
+                 compress='DEFLATE'):
+    """
+    Write a list of 2-D arrays, one per band, to a float32 GeoTIFF.
+
+    geotransform is the GDAL geotransform of the arrays and crs a string
+    accepted by SetFromUserInput (for example 'EPSG:4326'). NaN is used as
+    the nodata value. If band_info (a list of BandInfo) is given, band names
+    and metadata are set from it. Returns the output path.
+    """
+    gdal = _gdal()
+    from osgeo import osr
+
+    height, width = arrays[0].shape
+    ds = gdal.GetDriverByName('GTiff').Create(
+        out_path, width, height, len(arrays), gdal.GDT_Float32,
+        options=['TILED=YES',
+                 'COMPRESS={}'.format(compress),
+                 'BIGTIFF=IF_SAFER'])
+    ds.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(crs)
+    ds.SetProjection(srs.ExportToWkt())
+    for n, a in enumerate(arrays):
+        ds.GetRasterBand(n + 1).WriteArray(a)
+        ds.GetRasterBand(n + 1).SetNoDataValue(float('nan'))
+    if band_info:
+        _set_band_info(ds, [{'name': bi.name, 'metadata': bi.metadata}
+                            for bi in band_info])
+    ds = None
+    return out_path
@@ -9,7 +9,7 @@ from landdegradation.schemas.schemas import BandInfo
 
 
 def soc(geometry,year_start, year_end, fl, remap_matrix, dl_annual_lc, EXECUTION_ID, 
-        logger):
+        logger, lc=None):
     """
     Calculate SOC indicator.
     """
@@ -23,9 +23,10 @@ def soc(geometry,year_start, year_end, fl, remap_matrix, dl_annual_lc, EXECUTION
 
     # land cover - note it needs to be reprojected to match soc so that it can 
     # be output to cloud storage in the same stack
-    lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018") \
-            .select(ee.List.sequence(year_start - 1992, year_end - 1992, 1)) \
-            .clip(area) \
+    if lc is None:
+        lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018") \
+                .clip(area)
+    lc = lc.select(ee.List.sequence(year_start - 1992, year_end - 1992, 1)) \
             .reproject(crs=soc.projection())
             
     lc = lc.where(lc.eq(9999), -32768)
@@ -5,11 +5,20 @@ from __future__ import print_function
 import ee
 
 from landdegradation import stats, GEEIOError
-from landdegradation.util import TEImage
+from landdegradation.util import TEImage, plan_storage, select_grid, \
+    to_grid, GRID_NATIVE
+from landdegradation.materialize import materialized
 from landdegradation.schemas.schemas import BandInfo
 
+# Input datasets used in computing the SQI
+SOIL_ASSETS = ["users/miswagrace/parent_material_northafrica",
+               "users/miswagrace/slope_north_africa",
+               "users/miswagrace/texture_north_africa",
+               "users/miswagrace/rock_fragment_north_africa",
+               "users/miswagrace/drainage_northafrica"]
 
-def soil_quality(depth, texture_matrix, geometry, EXECUTION_ID, logger):
+
+def soil_quality_index(depth, texture_matrix, geometry, logger, proj=None):
     """
     ===========================================================================================
                  SOIL QUALITY INDEX (SQI)
@@ -26,10 +35,10 @@ def soil_quality(depth, texture_matrix, geometry, EXECUTION_ID, logger):
     The formula used to compute the SQI from the above-mentioned parameters is as shown below:
 
     SQI = (parent material*soil depth*soil texture* slope* rock fragment*drainage)^1/6
-    """
 
-    logger.debug("Entering soil quality function.")
-    srtm = ee.Image("USGS/SRTMGL1_003")
+    The (unclassified) index is returned. If proj is given, parent material
+    and slope are resampled to it before the index is computed.
+    """
 
     # ==========================
     # PARENT MATERIAL
@@ -41,8 +50,9 @@ def soil_quality(depth, texture_matrix, geometry, EXECUTION_ID, logger):
     parent_material = ee.Image("users/miswagrace/parent_material_northafrica").clip(geometry)
     parent_material = parent_material.remap([1.0, 1.2, 1.4, 1.5, 1.6, 1.7, 2.0],[1.0, 1.7, 1.7, 1.7, 1.7, 1.7, 2.0])
 
-    # resample parent material to srtm projection
-    parent_material = parent_material.reproject(crs=srtm.projection())
+    # resample parent material to output projection
+    if proj is not None:
+        parent_material = parent_material.reproject(crs=proj)
     # remap parent material 
     # parent_material = parent_material.remap(parent_material_map[0], parent_material_map[1])
 
@@ -50,7 +60,8 @@ def soil_quality(depth, texture_matrix, geometry, EXECUTION_ID, logger):
     # SLOPE
     # ==========================
     slope = ee.Image("users/miswagrace/slope_north_africa").clip(geometry)
-    slope = slope.reproject(crs=srtm.projection())
+    if proj is not None:
+        slope = slope.reproject(crs=proj)
    
     # ==========================
     # TEXTURE
@@ -116,13 +127,40 @@ def soil_quality(depth, texture_matrix, geometry, EXECUTION_ID, logger):
         'drainage':soil_drainage.clip(geometry)
         }).rename('sqi')  
 
-    # classify output sqi into 3 classes 
-    sqi = sqi \
+    return sqi
+
+
+def soil_quality_classes(sqi):
+    """Classify the soil quality index into 3 classes."""
+    return sqi \
         .where(sqi.lt(1.13), 1) \
         .where(sqi.gte(1.13).And(sqi.lte(1.45)), 2) \
         .where(sqi.gt(1.45), 3)
-    
+
+
+def soil_quality(depth, texture_matrix, geometry, EXECUTION_ID, logger,
+                 grid=GRID_NATIVE):
+    """Calculate the soil quality index (SQI), classified into 3 classes.
+
+    grid is the output grid policy (see util.select_grid). The default uses
+    the grid of the coarsest soil input. Use a scale of 30 for the SRTM 30 m
+    grid used previously.
+    """
+    logger.debug("Entering soil quality function.")
+
+    soil_projs = [ee.Image(asset).projection() for asset in SOIL_ASSETS]
+    sqi = materialized('sqi', {'depth': depth, 'texture_matrix': texture_matrix},
+                       lambda: soil_quality_index(depth, texture_matrix, geometry, logger),
+                       geometry, lambda: select_grid(soil_projs, GRID_NATIVE),
+                       logger)
+
+    # classify output sqi into 3 classes 
+    sqi = soil_quality_classes(sqi)
+
+    # resample to the output grid, if needed
+    sqi = to_grid(sqi, soil_projs, grid)
 
     return TEImage(sqi,
-        [BandInfo("Soil Quality Index (cm deep)", add_to_map=True, metadata={'depth':depth})])
+        [BandInfo("Soil Quality Index (cm deep)", add_to_map=True, metadata={'depth':depth})],
+        storage=[plan_storage(1, 3, categorical=True)])
 
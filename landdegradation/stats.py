@@ -1,4 +1,5 @@
-import ee
+# Earth Engine is imported within the functions that use it, so that the
+# Kendall tables can be used without importing or initializing it.
 
 
 def get_kendall_coef(n, level=95):
@@ -35,6 +36,8 @@ def mann_kendall(imageCollection):
         A Google Earth Engine image collection with Mann Kendall statistic for
             each pixel.
     """
+    import ee
+
     TimeSeriesList = imageCollection.toList(50)
     NumberOfItems = TimeSeriesList.length().getInfo()
     ConcordantArray = []
@@ -51,3 +54,39 @@ def mann_kendall(imageCollection):
     DiscordantSum = ee.ImageCollection(DiscordantArray).sum()
     MKSstat = ConcordantSum.subtract(DiscordantSum)
     return MKSstat
+
+
+def mann_kendall_array(array_image, n, valid=None):
+    """Calculate Mann Kendall's S statistic of a per pixel array.
+
+    The same statistic as mann_kendall, for a series stored as an n x 1
+    array image (for example the residuals of a per pixel regression)
+    rather than as an image collection. The signs of the differences between
+    every pair of values are computed as one n x n array and summed over its
+    upper triangle, so the statistic takes a single pass.
+
+    Args:
+        array_image: A Google Earth Engine n x 1 array image.
+        n: The length of the series.
+        valid: An optional n x 1 array image of 1 for valid and 0 for missing
+            values. Pairs including a missing value are not counted.
+
+    Returns:
+        A Google Earth Engine image with Mann Kendall statistic for each
+            pixel.
+    """
+    import ee
+
+    # before[i, j] is the value at time i, after[i, j] the value at time j
+    before = ee.Image(array_image).arrayRepeat(1, n)
+    after = before.matrixTranspose()
+    # Only count pairs where i < j
+    upper = ee.Image(ee.Array([[1 if j > i else 0 for j in range(n)]
+                               for i in range(n)]))
+    signs = after.subtract(before).signum().multiply(upper)
+    if valid is not None:
+        valid = ee.Image(valid)
+        signs = signs.multiply(valid.matrixMultiply(valid.matrixTranspose()))
+    return signs \
+        .arrayReduce(ee.Reducer.sum(), [0, 1]) \
+        .arrayGet([0, 0])
@@ -8,15 +8,13 @@ from landdegradation.util import TEImage
 from landdegradation.schemas.schemas import BandInfo
 
 
-def urban_area(geojson, un_adju, EXECUTION_ID, logger):
-    """
-    Calculate urban area.
-    """
+# tileScale used when the statistics are evaluated interactively, to reduce
+# the memory used per tile
+STATS_TILE_SCALE = 4
 
-    logger.debug("Entering urban_area function.")
-
-    aoi = ee.Geometry(geojson)
 
+def _urban_inputs(un_adju):
+    "Urban series, urban extent masks and urban population density by year"
     # Read asset with the time series of urban extent
     urban_series = ee.Image("users/geflanddegradation/toolbox_datasets/urban_series").int32()
 
@@ -34,53 +32,85 @@ def urban_area(geojson, un_adju, EXECUTION_ID, logger):
     pop2010 = pop_densi.filter(ee.Filter.eq("system:index", "2010")).mean().multiply(100).int32()
     pop2015 = pop_densi.filter(ee.Filter.eq("system:index", "2015")).mean().multiply(100).int32()
 
+    # Urban extent in each year
+    urban_masks = {2000: urban_series.eq(1),
+                   2005: urban_series.gte(1).And(urban_series.lte(2)),
+                   2010: urban_series.gte(1).And(urban_series.lte(3)),
+                   2015: urban_series.gte(1).And(urban_series.lte(4))}
+
     # Use urban extent to mask population density data
-    urb_pop2000 = pop2000.updateMask(urban_series.eq(1))
-    urb_pop2005 = pop2005.updateMask(urban_series.gte(1).And(urban_series.lte(2)))
-    urb_pop2010 = pop2010.updateMask(urban_series.gte(1).And(urban_series.lte(3)))
-    urb_pop2015 = pop2015.updateMask(urban_series.gte(1).And(urban_series.lte(4)))
-		
-    # Compute mean population density per year
-    urb_pop2000m = urb_pop2000.reduceRegion(reducer=ee.Reducer.mean(), 
-                                            geometry=aoi, scale=30, 
-                                            maxPixels=1e12)
-    urb_pop2005m = urb_pop2005.reduceRegion(reducer= ee.Reducer.mean(), 
-                                            geometry=aoi, scale=30, 
-                                            maxPixels=1e12)
-    urb_pop2010m = urb_pop2010.reduceRegion(reducer=ee.Reducer.mean(), 
-                                            geometry=aoi, scale=30, 
-                                            maxPixels=1e12)
-    urb_pop2015m = urb_pop2015.reduceRegion(reducer=ee.Reducer.mean(), 
-                                            geometry=aoi, scale=30, 
-                                            maxPixels=1e12)
-		
-    # Compute urban area per year
-    pixel_area = urban_series.updateMask(urban_series.eq(1)).multiply(ee.Image.pixelArea())
-
-    urb_are2000 = urban_series.updateMask(urban_series.eq(1)).multiply(ee.Image.pixelArea()) \
-        .reduceRegion(reducer=ee.Reducer.sum(), geometry=aoi, scale=30,
-                      maxPixels=1e12)
-    urb_are2005 = urban_series.updateMask(urban_series.gte(1).And(urban_series.lte(2))).multiply(ee.Image.pixelArea()) \
-        .reduceRegion(reducer=ee.Reducer.sum(), geometry=aoi, scale=30,
-                      maxPixels=1e12)
-    urb_are2010 = urban_series.updateMask(urban_series.gte(1).And(urban_series.lte(3))).multiply(ee.Image.pixelArea()) \
-        .reduceRegion(reducer=ee.Reducer.sum(), geometry=aoi, scale=30,
-                      maxPixels=1e12)
-    urb_are2015 = urban_series.updateMask(urban_series.gte(1).And(urban_series.lte(4))).multiply(ee.Image.pixelArea()) \
-        .reduceRegion(reducer=ee.Reducer.sum(), geometry=aoi, scale=30,
-                      maxPixels=1e12)                              
+    urb_pop2000 = pop2000.updateMask(urban_masks[2000])
+    urb_pop2005 = pop2005.updateMask(urban_masks[2005])
+    urb_pop2010 = pop2010.updateMask(urban_masks[2010])
+    urb_pop2015 = pop2015.updateMask(urban_masks[2015])
+    urb_pop = {2000: urb_pop2000, 2005: urb_pop2005,
+               2010: urb_pop2010, 2015: urb_pop2015}
+
+    return urban_series, urban_masks, urb_pop
+
+
+def _urban_statistics(aoi, urban_masks, urb_pop, **kwargs):
+    """Mean urban population density and urban area for each year, as an
+    ee.Dictionary (not evaluated). kwargs are passed to reduceRegion."""
+    years = sorted(urban_masks.keys())
+    # Compute mean population density and urban area for all years in one
+    # pass: each statistic is a band, and the mean and sum are computed for
+    # all bands with a single combined reducer
+    stats_image = ee.Image.cat(
+        [urb_pop[year].rename('pop_dens{}'.format(year)) for year in years] +
+        [ee.Image.pixelArea().updateMask(urban_masks[year]).rename('urb_area{}'.format(year)) for year in years])
+    urb_stats = stats_image.reduceRegion(reducer=ee.Reducer.mean().combine(ee.Reducer.sum(), sharedInputs=True),
+                                         geometry=aoi, scale=30,
+                                         maxPixels=1e12, **kwargs)
 
     # Make a dictionary to contain results
-    result_table = ee.Dictionary({
-      "pop_dens2000": urb_pop2000m.get('population-density'),
-      "pop_dens2005": urb_pop2005m.get('population-density'),
-      "pop_dens2010": urb_pop2010m.get('population-density'),
-      "pop_dens2015": urb_pop2015m.get('population-density'),
-      "urb_area2000": urb_are2000.get('classification'),
-      "urb_area2005": urb_are2005.get('classification'),
-      "urb_area2010": urb_are2010.get('classification'),
-      "urb_area2015": urb_are2015.get('classification'),
-    })
+    result_table = {}
+    for year in years:
+        result_table['pop_dens{}'.format(year)] = urb_stats.get('pop_dens{}_mean'.format(year))
+        result_table['urb_area{}'.format(year)] = urb_stats.get('urb_area{}_sum'.format(year))
+    return ee.Dictionary(result_table)
+
+
+def urban_area_table(geojson, un_adju):
+    """
+    Urban statistics as an ee.FeatureCollection, for export with the raster.
+
+    The collection has one feature, without geometry, with the mean urban
+    population density (people/km2 * 100) and the urban area (in sq m) of
+    each year. Nothing is evaluated, so it can be exported with
+    ee.batch.Export.table for AOIs of any size.
+    """
+    aoi = ee.Geometry(geojson)
+    _, urban_masks, urb_pop = _urban_inputs(un_adju)
+    return ee.FeatureCollection([ee.Feature(None, _urban_statistics(aoi, urban_masks, urb_pop))])
+
+
+def urban_area(geojson, un_adju, EXECUTION_ID, logger, statistics=False):
+    """
+    Calculate urban area.
+
+    If statistics is True the mean urban population density (people/km2 *
+    100) and urban area (in sq m) for each year are evaluated interactively
+    (with bestEffort, so large AOIs are reduced at a coarser scale) and
+    returned in the metadata of the urban series band, under 'statistics'.
+    If the evaluation fails (for example by timing out) they are left out.
+    For large AOIs export urban_area_table instead.
+    """
+
+    logger.debug("Entering urban_area function.")
+
+    aoi = ee.Geometry(geojson)
+
+    urban_series, urban_masks, urb_pop = _urban_inputs(un_adju)
+
+    metadata = {'years': [2000, 2005, 2010, 2015]}
+    if statistics:
+        try:
+            metadata['statistics'] = _urban_statistics(aoi, urban_masks, urb_pop,
+                                                       bestEffort=True,
+                                                       tileScale=STATS_TILE_SCALE).getInfo()
+        except ee.EEException as e:
+            logger.debug("Failed to compute urban statistics: {}".format(e))
 
     # # Export the FeatureCollection.
     # Export.table.toDrive({
@@ -90,11 +120,11 @@ def urban_area(geojson, un_adju, EXECUTION_ID, logger):
     #   fileFormat: 'CSV'})
     #
     # Export raster
-    result_raster = urban_series.addBands(urb_pop2000).addBands(urb_pop2005).addBands(urb_pop2010).addBands(urb_pop2015)
+    result_raster = urban_series.addBands(urb_pop[2000]).addBands(urb_pop[2005]).addBands(urb_pop[2010]).addBands(urb_pop[2015])
 
     logger.debug("Setting up output.")
     out = TEImage(result_raster.clip(aoi),
-                  [BandInfo("Urban series", add_to_map=True, metadata={'years': [2000, 2005, 2010, 2015]}),
+                  [BandInfo("Urban series", add_to_map=True, metadata=metadata),
                    BandInfo("Population", metadata={'year': 2000}),
                    BandInfo("Population", metadata={'year': 2005}),
                    BandInfo("Population", metadata={'year': 2010}),
@@ -1,13 +1,16 @@
   
+import copy
 import json
+import math
 import ee
 import threading
 import random
-import requests
+import warnings
 
 from time import time, sleep
 
 from landdegradation import GEETaskFailure, GEEImageError
+from landdegradation import metrics
 from landdegradation.schemas.schemas import CloudResults, CloudResultsSchema, Url
 
 
@@ -18,11 +21,50 @@ BUCKET = "ldms"
 # cancelled
 TASK_TIMEOUT_MINUTES = 48 * 60
 
+# maxPixels used for exports. Jobs with more pixels than this in a region
+# would fail.
+MAX_PIXELS = 1e13
 
-def get_region(geom):
-    """Return ee.Geometry from supplied GeoJSON object."""
+# Largest number of pixels reduced per band when summarizing an export. With
+# more pixels in the regions the summaries are computed at a coarser scale.
+SUMMARY_MAX_PIXELS = 1e9
+
+# Largest number of values (pixels times bands) fetched synchronously by
+# TEImage.fetch, above which it falls back to a batch export
+FETCH_MAX_PIXELS = 5e7
+
+# Size in pixels of the tiles requested by TEImage.fetch, and the number of
+# tiles requested at once
+FETCH_TILE_SIZE = 512
+FETCH_THREADS = 8
+
+# Rough export throughput (bytes of output per second of task run time),
+# used to estimate run times when no task metrics have been recorded
+DEFAULT_BYTES_PER_SECOND = 1e6
+
+# Output grid policies. An output grid can also be given as a number, which is
+# used as the target scale (in meters).
+#   native: the grid of the coarsest input (no information is added by
+#           resampling coarse inputs to a finer grid)
+#   finest: the grid of the finest input
+GRID_NATIVE = 'native'
+GRID_FINEST = 'finest'
+
+# Approximate length of one degree of latitude, used to convert scales in
+# meters to tolerances in degrees
+METERS_PER_DEGREE = 111320
+
+
+def get_region(geom, scale=None):
+    """Return ee.Geometry from supplied GeoJSON object.
+
+    If scale (in meters) is given the coordinates are simplified and
+    quantized to that scale first (see simplify_coords).
+    """
     poly = get_coords(geom)
     ptype = get_type(geom)
+    if scale is not None:
+        poly = simplify_coords(poly, scale)
     if ptype.lower() == 'multipolygon':
         region = ee.Geometry.MultiPolygon(poly)
     else:
@@ -50,14 +92,179 @@ def get_type(geojson):
         return geojson.get('type')
 
 
+def _is_ring(coords):
+    "True if coords is a list of points rather than of rings or polygons"
+    return len(coords) > 0 and not isinstance(coords[0][0], (list, tuple))
+
+
+def _points(coords):
+    "All points in nested polygon or multipolygon coordinates"
+    if _is_ring(coords):
+        return coords
+    return [p for c in coords for p in _points(c)]
+
+
+def _simplify_ring(ring, tolerance):
+    "Douglas-Peucker simplification of a closed ring"
+    if len(ring) <= 4:
+        return ring
+    keep = [False] * len(ring)
+    keep[0] = keep[-1] = True
+    # Use an explicit stack so long rings do not hit the recursion limit
+    stack = [(0, len(ring) - 1)]
+    while stack:
+        start, end = stack.pop()
+        x1, y1 = ring[start][0], ring[start][1]
+        x2, y2 = ring[end][0], ring[end][1]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len = math.hypot(dx, dy)
+        max_dist = 0
+        index = None
+        for i in range(start + 1, end):
+            x, y = ring[i][0], ring[i][1]
+            if seg_len == 0:
+                dist = math.hypot(x - x1, y - y1)
+            else:
+                dist = abs(dy * x - dx * y + x2 * y1 - y2 * x1) / seg_len
+            if dist > max_dist:
+                max_dist = dist
+                index = i
+        if index is not None and max_dist > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    simplified = [p for p, k in zip(ring, keep) if k]
+    # A ring needs at least three distinct points
+    if len(simplified) < 4:
+        return ring
+    return simplified
+
+
+def quantize_coords(coords, digits):
+    "Round nested coordinates to the given number of decimal places"
+    if _is_ring(coords):
+        return [[round(v, digits) for v in p] for p in coords]
+    return [quantize_coords(c, digits) for c in coords]
+
+
+def simplify_coords(coords, scale, tolerance=None, digits=None):
+    """
+    Simplify polygon or multipolygon coordinates (in degrees) for a scale.
+
+    Each ring is simplified with the Douglas-Peucker algorithm, with a
+    tolerance (in degrees) that defaults to one pixel at the given scale (in
+    meters, at about METERS_PER_DEGREE meters per degree), so that the
+    simplification does not change the result at that scale. The
+    coordinates are then rounded to a tenth of the tolerance, or to digits
+    decimal places if given.
+    """
+    if tolerance is None:
+        tolerance = scale / METERS_PER_DEGREE
+    if digits is None:
+        digits = max(0, int(math.ceil(-math.log10(tolerance / 10))))
+
+    def simplify(c):
+        if _is_ring(c):
+            return _simplify_ring(c, tolerance)
+        return [simplify(r) for r in c]
+    return quantize_coords(simplify(coords), digits)
+
+
+def get_bounds(coords):
+    """Return the bounding box [xmin, ymin, xmax, ymax] of nested coordinates
+
+    The box can be used (as an ee.Geometry.Rectangle) in place of a complex
+    polygon where only the extent matters, for example in filterBounds,
+    keeping the exact polygon for the final clip.
+    """
+    points = _points(coords)
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def _grid_info(projections, image=None):
+    "Fetch crs and nominal scale of projections (and image) in one request"
+    info = {'scales': [p.nominalScale() for p in projections],
+            'crs': [p.crs() for p in projections]}
+    if image is not None:
+        info['image_scale'] = image.projection().nominalScale()
+        info['image_crs'] = image.projection().crs()
+    return ee.Dictionary(info).getInfo()
+
+
+def _select_grid_index(info, grid):
+    "Return the index of the input projection selected by a grid policy"
+    scales = info['scales']
+    if grid == GRID_NATIVE:
+        return scales.index(max(scales))
+    elif grid == GRID_FINEST:
+        return scales.index(min(scales))
+    else:
+        raise GEEImageError('Unrecognized output grid "{}"'.format(grid))
+
+
+def select_grid(projections, grid=GRID_NATIVE):
+    """Return the output ee.Projection for a list of input projections.
+
+    grid is GRID_NATIVE (coarsest input), GRID_FINEST (finest input), or a
+    number giving the target scale in meters (in the crs of the first
+    input).
+    """
+    if not isinstance(grid, str):
+        return projections[0].atScale(grid)
+    return projections[_select_grid_index(_grid_info(projections), grid)]
+
+
+def to_grid(image, projections, grid=GRID_NATIVE):
+    """Put image on the output grid selected from the input projections.
+
+    The image is only reprojected if it is not already on the selected grid.
+    """
+    info = _grid_info(projections, image)
+    if not isinstance(grid, str):
+        if info['image_crs'] == info['crs'][0] and info['image_scale'] == grid:
+            return image
+        return image.reproject(crs=projections[0].atScale(grid))
+    i = _select_grid_index(info, grid)
+    if info['crs'][i] == info['image_crs'] and info['scales'][i] == info['image_scale']:
+        return image
+    return image.reproject(crs=projections[i])
+
+
+class LazyImage(object):
+    """An ee.Image for a dataset that is only created when first used
+
+    Allows modules to define dataset handles at import time without needing
+    an initialized Earth Engine session. Attribute access is passed to the
+    underlying ee.Image.
+    """
+    def __init__(self, asset_id):
+        self.asset_id = asset_id
+        self._image = None
+
+    def get(self):
+        if self._image is None:
+            self._image = ee.Image(self.asset_id)
+        return self._image
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
 class gee_task(threading.Thread):
-    """Run earth engine task against the trends.earth API"""
+    """Run earth engine task against the trends.earth API
+
+    Metrics for the task (queue wait, run time, EECU usage, outcome and
+    output size) are reported to the metrics sink, labelled with indicator.
+    """
 
-    def __init__(self, task, prefix, logger):
+    def __init__(self, task, prefix, logger, indicator=None):
         threading.Thread.__init__(self)
         self.task = task
         self.prefix = prefix
         self.logger = logger
+        self.indicator = indicator if indicator else 'unknown'
         self.state = self.task.status().get('state')
         self.start()
 
@@ -75,14 +282,22 @@ class gee_task(threading.Thread):
             if (time() - self.start_time) / 60 > TASK_TIMEOUT_MINUTES:
                 self.logger.debug("GEE task {} timed out after {} hours".format(self.task.status().get('id'), (time() - self.start_time) / (60*60)))
                 ee.data.cancelTask(self.task.status().get('id'))
+                metrics.record_task(self.task.status(), self.indicator,
+                                    'TIMED_OUT', 'timeout')
                 raise GEETaskFailure(self.task)
+        status = self.task.status()
         if self.state == 'COMPLETED':
-            self.logger.debug("GEE task {} completed.".format(self.task.status().get('id')))
+            self.logger.debug("GEE task {} completed.".format(status.get('id')))
+            metrics.record_task(status, self.indicator, self.state)
         elif self.state == 'FAILED':
-            self.logger.debug("GEE task {} failed: {}".format(self.task.status().get('id'), self.task.status().get('error_message')))
+            self.logger.debug("GEE task {} failed: {}".format(status.get('id'), status.get('error_message')))
+            metrics.record_task(status, self.indicator, self.state,
+                                metrics.failure_reason(status.get('error_message')))
             raise GEETaskFailure(self.task)
         else:
-            self.logger.debug("GEE task {} returned status {}: {}".format(self.task.status().get('id'), self.state, self.task.status().get('error_message')))
+            self.logger.debug("GEE task {} returned status {}: {}".format(status.get('id'), self.state, status.get('error_message')))
+            metrics.record_task(status, self.indicator, self.state,
+                                metrics.failure_reason(status.get('error_message')))
             raise GEETaskFailure(self.task)
 
     def status(self):
@@ -90,12 +305,16 @@ class gee_task(threading.Thread):
         return self.state
 
     def get_urls(self):
+        import requests
         resp = requests.get('https://www.googleapis.com/storage/v1/b/{bucket}/o?prefix={prefix}'.format(bucket=BUCKET, prefix=self.prefix))
         if not resp or resp.status_code != 200:
             raise GEETaskFailure('Failed to list urls for results from {}'.format(self.task))
 
-        items = resp.json()['items']
-        
+        # Keep only the files of this task, named prefix.tif or
+        # prefix-<tile>.tif, and not those of tasks whose name extends the
+        # prefix (as name_10 does name_1)
+        items = [item for item in resp.json().get('items', [])
+                 if item['name'][len(self.prefix):len(self.prefix) + 1] in ('.', '-')]
 
         if len(items) < 1:
             raise GEETaskFailure('No urls were found for {}'.format(self.task))
@@ -104,18 +323,220 @@ class gee_task(threading.Thread):
             for item in items:
                 self.logger.debug("items are {} and {}".format(item['mediaLink'], item['md5Hash']))
                 urls.append(Url(item['mediaLink'], item['md5Hash']))
+            metrics.record_output(self.indicator, len(items),
+                                  sum(int(item.get('size', 0)) for item in items))
             return urls
 
 
+# Integer storage types, from smallest to largest, with their value ranges
+# and the names of the ee.Image methods used to cast to them
+STORAGE_TYPES = [('uint8', 0, 255, 'toUint8'),
+                 ('int8', -128, 127, 'toInt8'),
+                 ('uint16', 0, 65535, 'toUint16'),
+                 ('int16', -32768, 32767, 'toInt16'),
+                 ('uint32', 0, 4294967295, 'toUint32'),
+                 ('int32', -2147483648, 2147483647, 'toInt32')]
+
+
+class BandStorage(object):
+    """Storage spec for one band of a TEImage
+
+    Values are stored as round((value - offset) / scale) in the given data
+    type, with masked pixels set to nodata. dtype is one of the names in
+    STORAGE_TYPES, or 'float' for bands that are stored unchanged.
+    """
+    def __init__(self, dtype, scale=1, offset=0, nodata=-32768,
+                 categorical=False):
+        self.dtype = dtype
+        self.scale = scale
+        self.offset = offset
+        self.nodata = nodata
+        self.categorical = categorical
+
+    def value_range(self):
+        "Range of stored values, including nodata"
+        for name, type_min, type_max, _ in STORAGE_TYPES:
+            if name == self.dtype:
+                return (type_min, type_max)
+        return None
+
+    def to_dict(self):
+        return {'dtype': self.dtype,
+                'scale': self.scale,
+                'offset': self.offset,
+                'nodata': self.nodata,
+                'categorical': self.categorical}
+
+
+def plan_storage(min_value, max_value, precision=1, categorical=False):
+    """Plan storage for a band with values between min_value and max_value
+
+    Returns a BandStorage using the smallest integer type that holds the
+    values at the given precision (which becomes the scale), with one value
+    of the type left free for nodata. For each type size the values are
+    tried as is and then with an offset of min_value, so that for example
+    years from 2000 are stored as uint8 (while values that fit a type of
+    that size as is keep offset 0). If no type fits the band is stored as
+    float.
+    """
+    for size in (8, 16, 32):
+        types = [t for t in STORAGE_TYPES if t[0].endswith(str(size))]
+        for offset in (0, min_value):
+            low = int(round((min_value - offset) / precision))
+            high = int(round((max_value - offset) / precision))
+            for name, type_min, type_max, _ in types:
+                if low > type_min and high <= type_max:
+                    nodata = type_min
+                elif low >= type_min and high < type_max:
+                    nodata = type_max
+                else:
+                    continue
+                return BandStorage(name, scale=precision, offset=offset,
+                                   nodata=nodata, categorical=categorical)
+    return BandStorage('float', nodata=-32768, categorical=categorical)
+
+
+def _common_storage_type(storage):
+    "Smallest type holding the stored values of all bands, or None for float"
+    low = min(s.value_range()[0] for s in storage)
+    high = max(s.value_range()[1] for s in storage)
+    for name, type_min, type_max, method in STORAGE_TYPES:
+        if low >= type_min and high <= type_max:
+            return method
+    return None
+
+
+def _pixel_type_bytes(data_type):
+    "Bytes per pixel of an ee.PixelType, given as returned by getInfo"
+    if data_type.get('precision') == 'float':
+        return 4
+    if data_type.get('precision') == 'double':
+        return 8
+    for name, min_value, max_value, _ in STORAGE_TYPES:
+        if data_type.get('min', 0) >= min_value and data_type.get('max', 0) <= max_value:
+            return int(''.join(c for c in name if c.isdigit())) // 8
+    return 8
+
+
+def _storage_bytes(storage, band_types=None):
+    """Bytes per pixel per band of an exported image
+
+    Without a storage spec for every band the image is exported as is, in
+    the largest of its band types (band_types, a dictionary of band names
+    and ee.PixelType info as from ee.Image.bandTypes). If band_types is not
+    given 4 bytes (the size of a float or int32) is assumed.
+    """
+    if any(s is None for s in storage):
+        if band_types:
+            return max(_pixel_type_bytes(t) for t in band_types.values())
+        return 4
+    if any(s.dtype == 'float' for s in storage):
+        return 4
+    cast = _common_storage_type(storage)
+    for name, _, _, method in STORAGE_TYPES:
+        if method == cast:
+            return int(''.join(c for c in name if c.isdigit())) // 8
+    return 4
+
+
+def _region_size(geojson, scale):
+    "Approximate (width, height) in pixels of the bounding box of a region"
+    xmin, ymin, xmax, ymax = get_bounds(get_coords(geojson))
+    lat = math.radians((ymin + ymax) / 2)
+    width = (xmax - xmin) * METERS_PER_DEGREE * math.cos(lat) / scale
+    height = (ymax - ymin) * METERS_PER_DEGREE / scale
+    return (int(math.ceil(width)), int(math.ceil(height)))
+
+
+def pixel_grid(bounds, scale, max_dim=None):
+    """Pixel grid over bounds for computePixels requests
+
+    bounds is [xmin, ymin, xmax, ymax] in degrees, and scale the pixel size
+    in meters, converted to degrees at METERS_PER_DEGREE. The grid is in
+    EPSG:4326. If max_dim is given the scale is coarsened if needed so that
+    neither dimension of the grid is larger than max_dim pixels. Returns the
+    grid as a dictionary in the form taken by ee.data.computePixels.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    size = scale / METERS_PER_DEGREE
+    if max_dim is not None:
+        size = max(size, (xmax - xmin) / max_dim, (ymax - ymin) / max_dim)
+    if size <= 0:
+        raise GEEImageError("Must specify a scale or a maximum dimension for the pixel grid")
+    return {'dimensions': {'width': max(1, int(math.ceil((xmax - xmin) / size))),
+                           'height': max(1, int(math.ceil((ymax - ymin) / size)))},
+            'affineTransform': {'scaleX': size,
+                                'shearX': 0,
+                                'translateX': xmin,
+                                'shearY': 0,
+                                'scaleY': -size,
+                                'translateY': ymax},
+            'crsCode': 'EPSG:4326'}
+
+
+def compute_pixels(image, grid, band_names):
+    """Fetch the pixels of image on grid, synchronously
+
+    Returns one 2-D float array per band in band_names, with masked pixels
+    set to NaN. Requests are limited by GEE to about 48 MB, so large grids
+    need to be split into tiles.
+    """
+    import numpy as np
+    data = ee.data.computePixels({'expression': image.select(band_names).unmask(-32768).toFloat(),
+                                  'fileFormat': 'NUMPY_NDARRAY',
+                                  'grid': grid})
+    arrays = []
+    for name in band_names:
+        a = np.array(data[name], dtype='float64')
+        a[a == -32768] = np.nan
+        arrays.append(a)
+    return arrays
+
+
+def _grid_tiles(grid, tile_size):
+    "Split a pixel grid into tiles, yielding (x offset, y offset, tile grid)"
+    width = grid['dimensions']['width']
+    height = grid['dimensions']['height']
+    transform = grid['affineTransform']
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile = dict(grid)
+            tile['dimensions'] = {'width': min(tile_size, width - x),
+                                  'height': min(tile_size, height - y)}
+            tile['affineTransform'] = dict(transform)
+            tile['affineTransform']['translateX'] = transform['translateX'] + x * transform['scaleX']
+            tile['affineTransform']['translateY'] = transform['translateY'] + y * transform['scaleY']
+            yield (x, y, tile)
+
+
+def _format_options(cloud_optimized=False, shard_size=None,
+                    file_dimensions=None):
+    "Return the GeoTIFF layout options for an export to cloud storage"
+    options = {'fileFormat': 'GeoTIFF'}
+    if cloud_optimized:
+        options['formatOptions'] = {'cloudOptimized': True}
+    if shard_size:
+        options['shardSize'] = shard_size
+    if file_dimensions:
+        options['fileDimensions'] = file_dimensions
+    return options
+
+
 class TEImage(object):
     "A class to store GEE images and band info for export to cloud storage"
-    def __init__(self, image, band_info):
+    def __init__(self, image, band_info, storage=None):
         self.image = image
         self.band_info = band_info
+        if storage is None:
+            storage = [None] * len(band_info)
+        self.storage = storage
 
         self._check_validity()
     
     def _check_validity(self):
+        if len(self.storage) != len(self.band_info):
+            raise GEEImageError('Storage length ({}) does not match band info length ({})'.format(len(self.storage),
+                                                                                                   len(self.band_info)))
         if len(self.band_info) != len(self.image.getInfo()['bands']):
             raise GEEImageError('Band info length ({}) does not match number of bands in image ({})'.format(len(self.band_info),
                                                                                                             len(self.image.getInfo()['bands'])))
@@ -124,13 +545,17 @@ class TEImage(object):
         "Merge with another TEImage object"
         self.image = self.image.addBands(other.image)
         self.band_info.extend(other.band_info)
+        self.storage.extend(other.storage)
 
         self._check_validity()
 
-    def addBands(self, bands, band_info):
+    def addBands(self, bands, band_info, storage=None):
         "Add new bands to the image"
         self.image = self.image.addBands(bands)
         self.band_info.extend(band_info)
+        if storage is None:
+            storage = [None] * len(band_info)
+        self.storage.extend(storage)
 
         self._check_validity()
 
@@ -141,6 +566,7 @@ class TEImage(object):
             raise GEEImageError('Bands "{}" not in image'.format(band_names))
 
         self.band_info = [self.band_info[i] for i in band_indices]
+        self.storage = [self.storage[i] for i in band_indices]
         self.image = self.image.select(band_indices)
 
         self._check_validity()
@@ -153,16 +579,176 @@ class TEImage(object):
             else:
                 self.band_info[i].add_to_map = False
 
-    def export(self, geojsons, task_name, crs, logger, execution_id=None, 
-               proj=None):
-        "Export layers to cloud storage"
+    def setStorage(self, band_names, storage):
+        "Set the storage spec (a BandStorage) used on export for certain bands"
+        found = False
+        for i in range(len(self.band_info)):
+            if self.band_info[i].name in band_names:
+                self.storage[i] = storage
+                found = True
+        if not found:
+            raise GEEImageError('Bands "{}" not in image'.format(band_names))
+
+    def _export_image(self):
+        """Return the image to export, with the storage specs applied
+
+        If storage is set for every band, each band is scaled and its masked
+        pixels set to nodata, and the image is cast to the smallest type that
+        holds all bands (GEE requires a single data type per exported file).
+        If storage is set for only some of the bands it cannot be applied,
+        and the image is exported as is with a warning. The band info is not
+        changed (see _export_band_info).
+        """
+        if all(s is None for s in self.storage):
+            return self.image
+        if any(s is None for s in self.storage):
+            missing = [bi.name for bi, s in zip(self.band_info, self.storage) if s is None]
+            warnings.warn('Storage is not set for bands {}, so it is not applied to any band'.format(missing))
+            return self.image
+
+        bands = []
+        for i, s in enumerate(self.storage):
+            band = self.image.select(i)
+            nodata = getattr(self.band_info[i], 'no_data_value', -32768)
+            band = band.updateMask(band.neq(nodata))
+            if s.dtype != 'float':
+                band = band.subtract(s.offset).divide(s.scale).round()
+            bands.append(band.unmask(s.nodata))
+        image = ee.Image.cat(bands)
+
+        if any(s.dtype == 'float' for s in self.storage):
+            return image.toFloat()
+        cast = _common_storage_type(self.storage)
+        if cast is None:
+            return image.toFloat()
+        return getattr(image, cast)()
+
+    def _export_band_info(self):
+        """Return copies of the band info describing the exported image
+
+        If the storage specs are applied on export, each copy has the nodata
+        value of its stored band, and the storage spec in its metadata.
+        """
+        band_info = [copy.copy(bi) for bi in self.band_info]
+        if any(s is None for s in self.storage):
+            return band_info
+        for bi, s in zip(band_info, self.storage):
+            if hasattr(bi, 'no_data_value'):
+                bi.no_data_value = s.nodata
+            metadata = dict(bi.metadata or {})
+            metadata['storage'] = s.to_dict()
+            bi.metadata = metadata
+        return band_info
+
+    def _export_proj(self, proj=None, grid=None):
+        "Output projection for the grid policy or projection"
+        if grid is not None:
+            band_projs = [self.image.select(i).projection() for i in range(len(self.band_info))]
+            return select_grid(band_projs, grid)
+        elif not proj:
+            return self.image.projection()
+        return proj
+
+    def _export_scale(self, proj=None, grid=None):
+        "Output scale in meters for the grid policy or projection"
+        return ee.Number(self._export_proj(proj, grid).nominalScale()).getInfo()
+
+    def estimate(self, geojsons, proj=None, grid=None, scale=None,
+                 file_dimensions=None, indicator=None):
+        """Estimate the size and cost of an export, without starting it
+
+        For each region the output pixel count is estimated from the
+        bounding box of the geometry at the output scale (which is computed
+        from proj or grid as in export, unless given). The bytes follow from
+        the storage data type of the bands (or, for bands without a storage
+        spec, the data type of the image bands), and the number of files from
+        file_dimensions (without it one file per region is assumed, though
+        GEE may split very large files). The run time is estimated from the
+        export throughput recorded in the task metrics (for indicator if
+        given, otherwise over all export tasks), including the metrics
+        persisted to LANDDEGRADATION_METRICS_FILE by earlier runs, or
+        DEFAULT_BYTES_PER_SECOND.
+
+        Returns a dictionary with the totals and a list of per region
+        estimates. exceeds_max_pixels is True if any region has more than
+        MAX_PIXELS pixels.
+        """
+        # Evaluate the scale and band types that are needed in one request
+        info = {}
+        if scale is None:
+            info['scale'] = ee.Number(self._export_proj(proj, grid).nominalScale())
+        if any(s is None for s in self.storage):
+            info['band_types'] = self.image.bandTypes()
+        if info:
+            info = ee.Dictionary(info).getInfo()
+            scale = info.get('scale', scale)
+        n_bands = len(self.band_info)
+        band_bytes = _storage_bytes(self.storage, info.get('band_types'))
+        if file_dimensions is None:
+            file_w = file_h = None
+        elif isinstance(file_dimensions, (list, tuple)):
+            file_w, file_h = file_dimensions
+        else:
+            file_w = file_h = file_dimensions
+
+        regions = []
+        for geojson in geojsons:
+            width, height = _region_size(geojson, scale)
+            pixels = width * height
+            if file_w:
+                files = int(math.ceil(width / file_w) * math.ceil(height / file_h))
+            else:
+                files = 1
+            regions.append({'width': width,
+                            'height': height,
+                            'pixels': pixels,
+                            'bytes': pixels * n_bands * band_bytes,
+                            'files': files,
+                            'exceeds_max_pixels': pixels > MAX_PIXELS})
+
+        sink = metrics.get_sink()
+        labels = {'indicator': indicator} if indicator else None
+        # Materialization tasks write assets rather than files, so their
+        # run time says nothing about export throughput
+        exclude = {'indicator': 'materialize'}
+        out_bytes = sink.total('gee_task_output_bytes_total', labels, exclude)
+        run_seconds = sink.total('gee_task_run_seconds', labels, exclude)
+        if out_bytes and run_seconds:
+            throughput = out_bytes / run_seconds
+        else:
+            throughput = DEFAULT_BYTES_PER_SECOND
+
+        total_bytes = sum(r['bytes'] for r in regions)
+        return {'scale': scale,
+                'bands': n_bands,
+                'bytes_per_pixel': n_bands * band_bytes,
+                'pixels': sum(r['pixels'] for r in regions),
+                'bytes': total_bytes,
+                'files': sum(r['files'] for r in regions),
+                'seconds': total_bytes / throughput,
+                'bytes_per_second': throughput,
+                'exceeds_max_pixels': any(r['exceeds_max_pixels'] for r in regions),
+                'regions': regions}
+
+    def start_export(self, geojsons, task_name, crs, logger, execution_id=None,
+                     proj=None, grid=None, scale=None, cloud_optimized=False,
+                     shard_size=None, file_dimensions=None, indicator=None):
+        """Start export tasks to cloud storage, one per geojson
+
+        The tasks are started but not waited on. Returns the list of
+        gee_task threads, to be passed to collect_results. scale (in
+        meters) overrides the scale of proj or grid. indicator labels the
+        task metrics ('unknown' if not given). See export for the other
+        arguments.
+        """
         if not execution_id:
             execution_id = str(random.randint(1000000, 99999999))
         else:
             execution_id = execution_id
 
-        if not proj:
-            proj = self.image.projection()
+        if scale is None:
+            scale = self._export_scale(proj, grid)
+        image = self._export_image()
         tasks = []
         n = 1
         for geojson in geojsons:
@@ -171,78 +757,329 @@ class TEImage(object):
             else:
                 out_name = '{}_{}'.format(execution_id, n)
 
-            export = {'image': self.image,
+            export = {'image': image,
                       'description': out_name,
                       'fileNamePrefix': out_name,
                       'bucket': BUCKET,
-                      'maxPixels': 1e13,
+                      'maxPixels': MAX_PIXELS,
                       'crs': crs,
-                      'scale': ee.Number(proj.nominalScale()).getInfo(),
+                      'scale': scale,
                       'region': get_coords(geojson)}
+            export.update(_format_options(cloud_optimized, shard_size,
+                                          file_dimensions))
             t = gee_task(ee.batch.Export.image.toCloudStorage(**export),
-                         out_name, logger)
+                         out_name, logger, indicator=indicator)
             tasks.append(t)
             n+=1
-            
-        logger.debug("Exporting to cloud storage.")
+        return tasks
+
+    def summarize(self, geojsons, scale):
+        """Compute summary statistics of each band over the export regions
+
+        Categorical bands (those with categorical storage) get the area (in
+        sq km) of each class, from a sum of pixel areas grouped by class.
+        Other bands get their min, max and mean and a histogram, from one
+        combined reducer. The statistics are of the band values before any
+        storage scaling, and are computed at scale (in meters), or a coarser
+        scale if the regions hold more than SUMMARY_MAX_PIXELS pixels. Each summary is added to the metadata of
+        its band under 'summary', and the list of summaries is returned.
+
+        The statistics are evaluated synchronously, so this raises
+        ee.EEException if they can not be computed interactively.
+        """
+        n_bands = len(self.band_info)
+        names = ['band_{}'.format(i) for i in range(n_bands)]
+        bands = []
+        for i, bi in enumerate(self.band_info):
+            band = self.image.select(i)
+            bands.append(band.updateMask(band.neq(getattr(bi, 'no_data_value', -32768))))
+        image = ee.Image.cat(bands).rename(names)
+        region = ee.FeatureCollection([ee.Feature(get_region(g)) for g in geojsons]).geometry()
+
+        categorical = [i for i in range(n_bands)
+                       if self.storage[i] is not None and self.storage[i].categorical]
+        continuous = [i for i in range(n_bands) if i not in categorical]
+
+        def reduce(image, reducer):
+            return image.reduceRegion(reducer=reducer, geometry=region,
+                                      scale=scale, maxPixels=SUMMARY_MAX_PIXELS,
+                                      bestEffort=True)
+
+        reductions = {}
+        for i in categorical:
+            reductions[names[i]] = reduce(ee.Image.pixelArea().divide(1e6).addBands(image.select(names[i])),
+                                          ee.Reducer.sum().group(groupField=1, groupName='class'))
+        if continuous:
+            reductions['continuous'] = reduce(image.select([names[i] for i in continuous]),
+                                              ee.Reducer.minMax() \
+                                              .combine(ee.Reducer.mean(), sharedInputs=True) \
+                                              .combine(ee.Reducer.histogram(), sharedInputs=True))
+        # Evaluate all reductions in one request
+        results = ee.Dictionary(reductions).getInfo()
+
+        summaries = []
+        for i in range(n_bands):
+            if i in categorical:
+                areas = dict(('{:g}'.format(group['class']), group['sum'])
+                             for group in results[names[i]]['groups'])
+                summary = {'type': 'categorical',
+                           'class_areas': areas,
+                           'area_units': 'sq km'}
+            else:
+                stats = results['continuous']
+                summary = {'type': 'continuous',
+                           'min': stats.get('{}_min'.format(names[i])),
+                           'max': stats.get('{}_max'.format(names[i])),
+                           'mean': stats.get('{}_mean'.format(names[i])),
+                           'histogram': stats.get('{}_histogram'.format(names[i]))}
+            summary['scale'] = scale
+            metadata = dict(self.band_info[i].metadata or {})
+            metadata['summary'] = summary
+            self.band_info[i].metadata = metadata
+            summaries.append(summary)
+        return summaries
+
+    def _fetch_image(self):
+        "Image with bands named band_<n> and nodata masked, for fetching pixels"
+        names = ['band_{}'.format(i) for i in range(len(self.band_info))]
+        bands = []
+        for i, bi in enumerate(self.band_info):
+            band = self.image.select(i)
+            bands.append(band.updateMask(band.neq(getattr(bi, 'no_data_value', -32768))))
+        return ee.Image.cat(bands).rename(names), names
+
+    def preview(self, geojson, scale=None, max_dim=512):
+        """Evaluate the image at a coarse scale over a region, synchronously
+
+        The pixels are computed directly (with ee.data.computePixels) rather
+        than through a batch export, so a preview takes seconds. scale (in
+        meters) defaults to the coarsest scale at which the bounding box of
+        the region is max_dim pixels across, and is coarsened to that if
+        smaller. Returns a list of (BandInfo, array) tuples, one per band,
+        with masked pixels set to NaN. Requires numpy.
+        """
+        grid = pixel_grid(get_bounds(get_coords(geojson)),
+                          scale if scale is not None else 0, max_dim=max_dim)
+        image, names = self._fetch_image()
+        arrays = compute_pixels(image, grid, names)
+        return list(zip(self.band_info, arrays))
+
+    def _fetch_grid(self, geojson, scale=None, proj=None, grid=None):
+        "Pixel grid of a fetch over a region, and its number of values"
+        if scale is None:
+            scale = self._export_scale(proj, grid)
+        full_grid = pixel_grid(get_bounds(get_coords(geojson)), scale)
+        n_values = full_grid['dimensions']['width'] * \
+            full_grid['dimensions']['height'] * len(self.band_info)
+        return full_grid, n_values
+
+    def fetch(self, geojson, logger, scale=None, proj=None, grid=None,
+              out_path=None, max_pixels=FETCH_MAX_PIXELS,
+              tile_size=FETCH_TILE_SIZE, threads=FETCH_THREADS):
+        """Fetch the image over a region synchronously, for small regions
+
+        The bounding box of the region is split into tiles of tile_size
+        pixels, which are computed directly (with ee.data.computePixels)
+        by a pool of threads and assembled locally, skipping the batch
+        queue. The scale is set by scale, proj or grid as in export. The
+        pixels are fetched on an EPSG:4326 grid.
+
+        If out_path is given the result is written there as a GeoTIFF (with
+        GDAL, see raster.write_arrays) and the path is returned. Otherwise a
+        list of (BandInfo, array) tuples is returned, as from preview.
+
+        If the image has more than max_pixels values (pixels times bands)
+        over the region a GEEImageError is raised. Use fetch_or_export to
+        fall back to a batch export instead.
+        """
+        full_grid, n_values = self._fetch_grid(geojson, scale, proj, grid)
+        width = full_grid['dimensions']['width']
+        height = full_grid['dimensions']['height']
+        if n_values > max_pixels:
+            raise GEEImageError("{} values over the region exceed the fetch budget of {}, use export instead".format(n_values, max_pixels))
+
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+
+        image, names = self._fetch_image()
+        tiles = list(_grid_tiles(full_grid, tile_size))
+        logger.debug("Fetching {} by {} pixels in {} tiles.".format(width, height, len(tiles)))
+
+        def fetch_tile(tile):
+            x, y, tile_grid = tile
+            return (x, y, compute_pixels(image, tile_grid, names))
+
+        arrays = [np.full((height, width), np.nan) for _ in names]
+        pool = ThreadPoolExecutor(max_workers=threads)
+        try:
+            for x, y, tile_arrays in pool.map(fetch_tile, tiles):
+                for a, t in zip(arrays, tile_arrays):
+                    a[y:y + t.shape[0], x:x + t.shape[1]] = t
+        finally:
+            pool.shutdown()
+
+        if out_path:
+            from landdegradation import raster
+            t = full_grid['affineTransform']
+            geotransform = (t['translateX'], t['scaleX'], t['shearX'],
+                            t['translateY'], t['shearY'], t['scaleY'])
+            return raster.write_arrays(out_path, arrays, geotransform,
+                                       full_grid['crsCode'], self.band_info)
+        return list(zip(self.band_info, arrays))
+
+    def _dry_run(self, geojsons, task_name, logger, **kwargs):
+        "Estimate an export and log the estimate"
+        estimate = self.estimate(geojsons, **kwargs)
+        logger.debug("Dry run of {}: {} pixels, {} bytes in {} files, about {:.0f} seconds.".format(task_name, estimate['pixels'], estimate['bytes'], estimate['files'], estimate['seconds']))
+        if estimate['exceeds_max_pixels']:
+            logger.debug("Dry run of {}: a region exceeds maxPixels of {}.".format(task_name, MAX_PIXELS))
+        return estimate
+
+    def collect_results(self, task_name, tasks):
+        "Wait for export tasks and return their results as CloudResults JSON"
         urls = []
         for task in tasks:
             task.join()
             urls.extend(task.get_urls())
 
         gee_results = CloudResults(task_name,
-                                   self.band_info,
+                                   self._export_band_info(),
                                    urls)
         results_schema = CloudResultsSchema()
         json_results = results_schema.dump(gee_results)
 
         return json_results
 
+    def export(self, geojsons, task_name, crs, logger, execution_id=None, 
+               proj=None, grid=None, cloud_optimized=False, shard_size=None,
+               file_dimensions=None, dry_run=False, summaries=False,
+               indicator=None):
+        """Export layers to cloud storage
+
+        grid optionally sets the output grid policy: GRID_NATIVE (coarsest
+        band), GRID_FINEST (finest band) or a target scale in meters. It
+        takes precedence over proj.
+
+        If cloud_optimized is True the files are written as cloud-optimized
+        GeoTIFFs. shard_size (the tile size in pixels) and file_dimensions
+        (the size in pixels of each output file, which should be a multiple
+        of shard_size so that files are tile-aligned) are passed to GEE.
+
+        If dry_run is True no tasks are started, and the estimate of the
+        export (see estimate) is returned instead of the results.
+
+        If summaries is True, summary statistics of each band (see
+        summarize) are computed while the export runs and included in the
+        band metadata of the results. If they can not be computed the
+        failure is logged and the results have no summaries.
+
+        indicator labels the task metrics.
+        """
+        if dry_run:
+            return self._dry_run(geojsons, task_name, logger, proj=proj,
+                                 grid=grid, file_dimensions=file_dimensions,
+                                 indicator=indicator)
+        tasks = self.start_export(geojsons, task_name, crs, logger,
+                                  execution_id=execution_id, proj=proj,
+                                  grid=grid, cloud_optimized=cloud_optimized,
+                                  shard_size=shard_size,
+                                  file_dimensions=file_dimensions,
+                                  indicator=indicator)
+        logger.debug("Exporting to cloud storage.")
+        if summaries:
+            logger.debug("Computing band summaries.")
+            try:
+                self.summarize(geojsons, self._export_scale(proj, grid))
+            except ee.EEException as e:
+                logger.debug("Failed to compute band summaries: {}".format(e))
+        return self.collect_results(task_name, tasks)
+
 
     # scale issues temporary fix 
     def export_forest_fire(self, geojsons, task_name, crs, logger, execution_id=None, 
-        proj=None):
+        proj=None, cloud_optimized=False, shard_size=None, file_dimensions=None,
+        dry_run=False, indicator=None):
         "Export layers to cloud storage"
-        if not execution_id:
-            execution_id = str(random.randint(1000000, 99999999))
-        else:
-            execution_id = execution_id
+        if dry_run:
+            return self._dry_run(geojsons, task_name, logger, scale=30,
+                                 file_dimensions=file_dimensions,
+                                 indicator=indicator)
+        tasks = self.start_export(geojsons, task_name, crs, logger,
+                                  execution_id=execution_id, proj=proj,
+                                  scale=30, cloud_optimized=cloud_optimized,
+                                  shard_size=shard_size,
+                                  file_dimensions=file_dimensions,
+                                  indicator=indicator)
+        logger.debug("Exporting to cloud storage.")
+        return self.collect_results(task_name, tasks)
 
-        if not proj:
-            proj = self.image.projection()
 
-        tasks = []
-        n = 1
-        for geojson in geojsons:
-            if task_name:
-                out_name = '{}_{}_{}'.format(execution_id, task_name, n)
-            else:
-                out_name = '{}_{}'.format(execution_id, n)
+def export_many(exports, crs, logger, execution_id=None, dry_run=False,
+                **kwargs):
+    """
+    Export several TEImages to cloud storage concurrently.
 
-            export = {'image': self.image,
-                      'description': out_name,
-                      'fileNamePrefix': out_name,
-                      'bucket': BUCKET,
-                      'maxPixels': 1e13,
-                      'crs': crs,
-                      'scale': 30,
-                      'region': get_coords(geojson)}
-            t = gee_task(ee.batch.Export.image.toCloudStorage(**export),
-                         out_name, logger)
-            tasks.append(t)
-            n+=1
-            
-        logger.debug("Exporting to cloud storage.")
-        
-        urls = []
-        for task in tasks:
-            task.join()
-            urls.extend(task.get_urls())
+    exports is a list of (te_image, geojsons, task_name) tuples. The tasks
+    of every export are started before any is waited on, so that they run
+    on GEE at the same time, and are then monitored together. The outputs
+    of each export are named with its position in exports, so exports with
+    the same task_name do not overwrite each other. kwargs are passed to
+    TEImage.start_export (for example scale or cloud_optimized).
+    Returns the CloudResults JSON of each export, in order, or if dry_run
+    is True the estimate of each export (see TEImage.estimate).
+    """
+    if dry_run:
+        return [te_image._dry_run(geojsons, task_name, logger,
+                                  scale=kwargs.get('scale'),
+                                  proj=kwargs.get('proj'),
+                                  grid=kwargs.get('grid'),
+                                  file_dimensions=kwargs.get('file_dimensions'),
+                                  indicator=kwargs.get('indicator'))
+                for te_image, geojsons, task_name in exports]
 
-        gee_results = CloudResults(task_name,
-                                   self.band_info,
-                                   urls)
-        results_schema = CloudResultsSchema()
-        json_results = results_schema.dump(gee_results)
+    if not execution_id:
+        execution_id = str(random.randint(1000000, 99999999))
+
+    started = []
+    for k, (te_image, geojsons, task_name) in enumerate(exports):
+        started.append((te_image, task_name,
+                        te_image.start_export(geojsons, task_name, crs, logger,
+                                              execution_id='{}_{}'.format(execution_id, k + 1),
+                                              **kwargs)))
+    n_tasks = sum(len(tasks) for _, _, tasks in started)
+    logger.debug("Exporting {} images in {} tasks to cloud storage.".format(len(started), n_tasks))
+
+    results = []
+    for n, (te_image, task_name, tasks) in enumerate(started):
+        results.append(te_image.collect_results(task_name, tasks))
+        logger.debug("Finished export {} of {}.".format(n + 1, len(started)))
+    return results
+
+
+def fetch_or_export(te_image, geojson, task_name, crs, logger, scale=None,
+                    proj=None, grid=None, out_path=None,
+                    max_pixels=FETCH_MAX_PIXELS, **kwargs):
+    """
+    Fetch a TEImage over a region, or export it if the region is too large.
+
+    If the image has at most max_pixels values over the region it is
+    fetched synchronously with TEImage.fetch (writing a GeoTIFF to out_path
+    if given). Otherwise it is exported to cloud storage as with
+    TEImage.export, passing kwargs (for example cloud_optimized or
+    indicator) to TEImage.start_export.
 
-        return json_results
\ No newline at end of file
+    Returns a dictionary with the mode ('fetch' or 'export') and the result:
+    the return value of fetch, or the CloudResults JSON of the export.
+    """
+    _, n_values = te_image._fetch_grid(geojson, scale, proj, grid)
+    if n_values <= max_pixels:
+        return {'mode': 'fetch',
+                'result': te_image.fetch(geojson, logger, scale=scale,
+                                         proj=proj, grid=grid,
+                                         out_path=out_path,
+                                         max_pixels=max_pixels)}
+    logger.debug("{} values over the region exceed the fetch budget of {}, exporting instead.".format(n_values, max_pixels))
+    tasks = te_image.start_export([geojson], task_name, crs, logger,
+                                  scale=scale, proj=proj, grid=grid, **kwargs)
+    return {'mode': 'export',
+            'result': te_image.collect_results(task_name, tasks)}
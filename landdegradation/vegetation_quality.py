@@ -5,10 +5,12 @@ from __future__ import print_function
 import ee
 
 from landdegradation import stats, GEEIOError
-from landdegradation.util import TEImage
+from landdegradation.util import TEImage, plan_storage
+from landdegradation.land_cover import load_lc
 from landdegradation.schemas.schemas import BandInfo
 
-def vegetation_quality(year, ndvi_start, ndvi_end, drought_matrix, fire_matrix, erosion_matrix, geometry, EXECUTION_ID,logger):
+def vegetation_quality_index(year, ndvi_start, ndvi_end, drought_matrix, fire_matrix, erosion_matrix, geometry, lc=None):
+    """Calculate the (unclassified) vegetation quality index."""
 
     drought_remap_matrix =  [
         [
@@ -35,18 +37,17 @@ def vegetation_quality(year, ndvi_start, ndvi_end, drought_matrix, fire_matrix,
     ]
 
     ## land cover
-    lc = ee.Image("users/geflanddegradation/toolbox_datasets/lcov_esacc_1992_2018").clip(geometry)
-    lc = lc.where(lc.eq(9999), -32768)
-    lc = lc.updateMask(lc.neq(-32768))
+    if lc is None:
+        lc = load_lc(geometry)
 
     # DEFINE DROUGHT RESISTANCE 
-    lc_remapped_drought = lc.select('y'+year).remap(drought_remap_matrix[0], drought_remap_matrix[1]).divide(10)
+    lc_remapped_drought = lc.select('y{}'.format(year)).remap(drought_remap_matrix[0], drought_remap_matrix[1]).divide(10)
 
     # DEFINE FIRE RISK
-    lc_remapped_fire = lc.select('y'+year).remap(fire_remap_matrix[0], fire_remap_matrix[1]).divide(10)
+    lc_remapped_fire = lc.select('y{}'.format(year)).remap(fire_remap_matrix[0], fire_remap_matrix[1]).divide(10)
 
     # DEFINE EROSION PROTECTION
-    lc_remapped_erosion = lc.select('y'+year).remap(erosion_remap_matrix[0], erosion_remap_matrix[1]).divide(10)
+    lc_remapped_erosion = lc.select('y{}'.format(year)).remap(erosion_remap_matrix[0], erosion_remap_matrix[1]).divide(10)
 
     # DEFINE PLANT COVER
     max_ndvi = ee.ImageCollection('VITO/PROBAV/C1/S1_TOC_100M') \
@@ -83,13 +84,26 @@ def vegetation_quality(year, ndvi_start, ndvi_end, drought_matrix, fire_matrix,
         }
     ).rename("Vegetation Quality Index")
 
-    vqi_range = vqi \
+    return vqi
+
+
+def vegetation_quality_classes(vqi):
+    """Classify the vegetation quality index into 3 classes."""
+    return vqi \
         .where(vqi.lte(1.13), 1) \
         .where(vqi.lte(1.38).And(vqi.gt(1.13)), 2) \
         .where(vqi.gt(1.38), 3)
 
+
+def vegetation_quality(year, ndvi_start, ndvi_end, drought_matrix, fire_matrix, erosion_matrix, geometry, EXECUTION_ID,logger):
+    logger.debug("Entering vegetation quality function.")
+    vqi = vegetation_quality_index(year, ndvi_start, ndvi_end, drought_matrix,
+                                   fire_matrix, erosion_matrix, geometry)
+    vqi_range = vegetation_quality_classes(vqi)
+
     return TEImage(vqi_range.clip(geometry),
-        [BandInfo("Vegetation Quality Index", add_to_map=True, metadata={'year':year})])
+        [BandInfo("Vegetation Quality Index", add_to_map=True, metadata={'year':year})],
+        storage=[plan_storage(1, 3, categorical=True)])
   
 
 
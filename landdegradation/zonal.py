@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import ee
+
+from landdegradation import GEEError
+
+# Target number of pixels reduced per request. Batches of units are sized so
+# that they cover about this many pixels at the reduction scale.
+BATCH_PIXELS = 1e9
+
+# Maximum number of units reduced per request
+MAX_BATCH_SIZE = 1000
+
+# Number of units whose extents are used to estimate the average unit size
+SIZE_SAMPLE = 100
+
+# Largest tileScale tried before a single unit is reported as failed
+MAX_TILE_SCALE = 16
+
+# Errors from GEE meaning that a request was too large to compute, and that
+# it should be split and retried
+RETRY_ERRORS = ('too many pixels', 'timed out', 'timeout', 'memory limit',
+                'too many concurrent aggregations')
+
+BAND_PREFIX = 'band_'
+
+
+def _is_retryable(error):
+    msg = str(error).lower()
+    return any(e in msg for e in RETRY_ERRORS)
+
+
+def _batch_size(units, scale):
+    """Number of units per batch, based on their average size in pixels
+
+    The size is estimated from the bounding boxes of up to SIZE_SAMPLE
+    units, each computed separately so the units are never unioned.
+    """
+    def bounds_area(feature):
+        return feature.set('bounds_area',
+                           feature.geometry().bounds(maxError=scale).area(maxError=scale))
+    area = units.limit(SIZE_SAMPLE).map(bounds_area) \
+        .aggregate_mean('bounds_area').getInfo()
+    unit_pixels = max((area or 0) / (scale * scale), 1)
+    return int(max(1, min(MAX_BATCH_SIZE, BATCH_PIXELS // unit_pixels)))
+
+
+def _rows(features, band_info):
+    "Convert reduced features to rows, mapping band names to band info"
+    band_re = re.compile('^{}(\\d+)(?:_(.*))?$'.format(BAND_PREFIX))
+    for feature in features:
+        properties = {}
+        bands = [{'name': bi.name, 'metadata': bi.metadata, 'stats': {}}
+                 for bi in band_info]
+        for key, value in feature['properties'].items():
+            match = band_re.match(key)
+            if match:
+                stat = match.group(2) if match.group(2) else 'value'
+                bands[int(match.group(1))]['stats'][stat] = value
+            else:
+                properties[key] = value
+        yield {'id': feature.get('id'), 'properties': properties,
+               'bands': bands}
+
+
+def zonal_statistics(te_image, units, scale, logger, reducer=None,
+                     batch_size=None, tile_scale=1):
+    """
+    Calculate zonal statistics of a TEImage over a collection of units.
+
+    The units (an ee.FeatureCollection, for example administrative areas)
+    are reduced with reduceRegions in batches. Unless batch_size is given,
+    the batches are sized from the average extent of the units so that each
+    covers about BATCH_PIXELS pixels at the given scale. A batch that fails
+    because it is too large (too many pixels, timeout or memory errors) is
+    split in two and each half retried. A single unit that still fails is
+    retried with a larger tileScale.
+
+    The statistics are yielded as one row per unit, as they are computed:
+
+        {'id': <feature id>,
+         'properties': <properties of the unit>,
+         'bands': [{'name': <band name>, 'metadata': <band metadata>,
+                    'stats': {<reducer output>: <value>, ...}}, ...]}
+
+    For a single output reducer (the default is the mean), the stat is
+    named 'value'.
+    """
+    logger.debug("Entering zonal_statistics function.")
+    if reducer is None:
+        reducer = ee.Reducer.mean()
+
+    n_bands = len(te_image.band_info)
+    band_names = ['{}{}'.format(BAND_PREFIX, i) for i in range(n_bands)]
+    image = te_image.image.rename(band_names)
+    # Name the outputs after the bands. Without this reduceRegions names the
+    # outputs of a single band image after the reducer alone.
+    reducer = reducer.forEach(band_names)
+
+    n = units.size().getInfo()
+    if n < 1:
+        return
+    units_list = units.toList(n)
+    if batch_size is None:
+        batch_size = _batch_size(units, scale)
+    logger.debug("Reducing {} units in batches of {}.".format(n, batch_size))
+
+    def reduce_batch(start, end, tile_scale):
+        batch = ee.FeatureCollection(units_list.slice(start, end))
+        try:
+            return image.reduceRegions(collection=batch, reducer=reducer,
+                                       scale=scale,
+                                       tileScale=tile_scale).getInfo()['features']
+        except ee.EEException as e:
+            if not _is_retryable(e):
+                raise
+            if end - start > 1:
+                logger.debug("Splitting units {} to {}: {}".format(start, end, e))
+                mid = (start + end) // 2
+                return reduce_batch(start, mid, tile_scale) + \
+                    reduce_batch(mid, end, tile_scale)
+            elif tile_scale < MAX_TILE_SCALE:
+                logger.debug("Retrying unit {} with tileScale {}: {}".format(start, tile_scale * 2, e))
+                return reduce_batch(start, end, tile_scale * 2)
+            else:
+                raise GEEError("Failed to compute statistics for unit {}: {}".format(start, e))
+
+    for start in range(0, n, batch_size):
+        features = reduce_batch(start, min(start + batch_size, n), tile_scale)
+        for row in _rows(features, te_image.band_info):
+            yield row
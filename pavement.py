@@ -116,6 +116,100 @@ def pylint(args):
     lint.Run(args)
 
 
+@task
+@cmdopts([
+    ('module=', 'm', 'Module to time (default: the package and each submodule)'),
+])
+def import_time(options):
+    """Benchmark cold import time of the package and its submodules"""
+    module = getattr(options, 'module', None)
+    if module:
+        modules = [module]
+    else:
+        modules = ['landdegradation'] + \
+            ['landdegradation.{}'.format(os.path.splitext(f)[0])
+             for f in sorted(os.listdir(options.source_dir))
+             if f.endswith('.py') and f != '__init__.py']
+    for module in modules:
+        # Each import runs in a fresh interpreter so that nothing is cached
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                            'import {}'.format(module)],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+        if p.returncode != 0:
+            print('{:<45} failed: {}'.format(module, p.stderr.strip().splitlines()[-1]))
+            continue
+        # The last line of the report is the module itself, with the
+        # cumulative time (in us) as the second column
+        cumulative = int(p.stderr.strip().splitlines()[-1].split('|')[1])
+        print('{:<45} {:>10.1f} ms'.format(module, cumulative / 1000.))
+
+
+
+def _rs_ratio_where_chain(climate, f_type, agb):
+    """Root to shoot ratio of one pixel from the where chain used in carbon.tc
+    before the packed lookup, with f_type 0 for pixels outside the forest
+    classes. Each where overwrites the result of the ones before it."""
+    r = -32768
+    if climate == 1 and agb <= 125: r = 0.42
+    if climate == 1 and agb >= 125: r = 0.24
+    if climate == 2: r = 0.27
+    if climate == 3 and f_type == 2 and agb <= 50: r = 0.46
+    if climate == 3 and f_type == 2 and 50 <= agb <= 150: r = 0.32
+    if climate == 3 and f_type == 2 and agb <= 150: r = 0.23
+    if climate == 3 and f_type == 1 and agb <= 75: r = 0.43
+    if climate == 3 and f_type == 1 and 75 <= agb <= 150: r = 0.26
+    if climate == 3 and f_type == 1 and agb <= 150: r = 0.24
+    if climate == 3 and f_type == 1 and agb <= 75: r = (0.46 + 0.43) / 2
+    if climate == 3 and f_type == 1 and 75 <= agb <= 150: r = (0.32 + 0.26) / 2
+    if climate == 3 and f_type == 1 and agb <= 150: r = (0.23 + 0.24) / 2
+    if f_type == 4: r = 2.8
+    return r
+
+
+def _rs_ratio_lookup_value(climate, f_type, agb, codes, ratios):
+    "Root to shoot ratio of one pixel from the packed lookup in carbon.tc"
+    low_threshold = {1: 75, 2: 50, 3: 75}.get(f_type, 75)
+    if climate == 1:
+        biomass_class = int(agb >= 125)
+    else:
+        biomass_class = int(agb > low_threshold) + int(agb > 150)
+    lookup = dict(zip(codes, ratios))
+    return lookup.get(climate * 100 + f_type * 10 + biomass_class, -32768)
+
+
+@task
+def check_rs_ratio():
+    """Check the packed root to shoot lookup against the old where chain
+
+    The two must agree everywhere except in temperate climates (3), where
+    the lookup fixes the high biomass thresholds and the mixed forest type
+    code of the where chain. Those differences are counted and reported.
+    """
+    sys.path.insert(0, os.path.abspath('.'))
+    from landdegradation.carbon import _rs_ratio_lookup
+    codes, ratios = _rs_ratio_lookup()
+    mismatches = []
+    temperate_changes = 0
+    for climate in [0, 1, 2, 3]:
+        for f_type in [0, 1, 2, 3, 4]:
+            for agb in [0, 25, 49, 50, 51, 74, 75, 76, 100, 124, 125, 126,
+                        149, 150, 151, 200, 400]:
+                old = _rs_ratio_where_chain(climate, f_type, agb)
+                new = _rs_ratio_lookup_value(climate, f_type, agb, codes, ratios)
+                if abs(old - new) < 1e-9:
+                    continue
+                if climate == 3 and f_type in (1, 2, 3):
+                    temperate_changes += 1
+                else:
+                    mismatches.append((climate, f_type, agb, old, new))
+    print('{} temperate forest cases changed by the threshold fixes'.format(temperate_changes))
+    if mismatches:
+        for m in mismatches:
+            print('climate {} forest type {} agb {}: where chain {}, lookup {}'.format(*m))
+        raise BuildFailure('{} mismatches between the where chain and the lookup'.format(len(mismatches)))
+    print('Root to shoot lookup matches the where chain outside temperate forests')
+
 ################################################
 # Below is based on pb_tool:
 # https://github.com/g-sherman/plugin_build_tool